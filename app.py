@@ -1,9 +1,13 @@
 import streamlit as st
-from PIL import Image
 import io
-from process_receipt import detectAndCorrectReceipt
-from resize import resize_image
-from layout_images import layout_images, create_pages, main
+from process_receipt import detectAndCorrectReceipts
+from extract_cache import get_extraction_cache
+from resize import resize_batch
+from layout_images import A4_HEIGHT, A4_WIDTH, layout_images_cached, print_layout_stats, render_pages_parallel
+from pdf_export import export_pdf
+from preview import ROTATION_PREVIEW_MAX_SIDE, content_hash, get_thumbnail, rotate_image
+from image_store import DecodedImages, EncodedBytes, EncodedImage, ImageCodec, SessionStore
+import metrics
 import logging
 import numpy as np
 
@@ -17,30 +21,107 @@ st.title("Receipt Processor")
 # Sidebar
 st.sidebar.header("Settings")
 
+# 各阶段的耗时统计，开启后在侧边栏显示本批次的报告；每个会话有自己的 Recorder 和开关，不修改全局设置
+if 'metrics_recorder' not in st.session_state:
+    st.session_state.metrics_recorder = metrics.Recorder()
+collect_metrics = st.sidebar.checkbox("Collect metrics", value=metrics.is_enabled())
+metrics.use(st.session_state.metrics_recorder if collect_metrics else None)
+
 # 使用文件上传器选择多张图片
 uploaded_files = st.sidebar.file_uploader("Upload Images", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True)
 
+# 会话中的中间图片共用一个内存预算（RECEIPT_MEMORY_BUDGET_MB），超出后溢出到临时目录，会话结束时删除
+if 'session_store' not in st.session_state:
+    st.session_state.session_store = SessionStore()
+session_store = st.session_state.session_store
+
 # 初始化字典并保存到 session_state
 if 'extracted_images' not in st.session_state:
-    st.session_state.extracted_images = {}
+    st.session_state.extracted_images = session_store.mapping('extracted')
 if 'resized_images' not in st.session_state:
-    st.session_state.resized_images = {}
+    st.session_state.resized_images = session_store.mapping('resized')
+# 导出文件（多页 PDF）只在用户需要时生成，同样计入会话的内存预算
+exports = session_store.mapping('exports')
+# 会话中的中间图片按部署配置的格式保存（RECEIPT_INTERMEDIATE_FORMAT），同时统计编解码耗时
+if 'image_codec' not in st.session_state:
+    st.session_state.image_codec = ImageCodec()
+codec = st.session_state.image_codec
+# 每个上传文件对应的 (内容哈希, 发票名称)，用于判断哪些上传已经提取过
+if 'extraction_sources' not in st.session_state:
+    st.session_state.extraction_sources = {}
+# 每个上传文件的内容哈希，按 (upload_id, 大小) 记住，重新运行页面时不再对所有上传重新计算
+if 'upload_digests' not in st.session_state:
+    st.session_state.upload_digests = {}
+
+def upload_id(uploaded_file):
+    """上传文件在会话中的标识，旧版本 Streamlit 没有 file_id"""
+    return getattr(uploaded_file, 'file_id', None) or getattr(uploaded_file, 'id', None) or uploaded_file.name
+
+def upload_digest(uploaded_file):
+    """上传文件的内容哈希，每个上传只计算一次"""
+    key = (upload_id(uploaded_file), uploaded_file.size)
+    digest = st.session_state.upload_digests.get(key)
+    if digest is None:
+        digest = st.session_state.upload_digests[key] = content_hash(uploaded_file.getvalue())
+    return digest
+
+def drop_result(name):
+    """删除一张发票的提取和缩放结果"""
+    st.session_state.extracted_images.pop(name, None)
+    st.session_state.resized_images.pop(name, None)
+
+def drop_removed_uploads(uploaded_files):
+    """删除已经从上传列表中移除的文件的结果"""
+    current = {upload_id(uploaded_file) for uploaded_file in uploaded_files or []}
+    for key in list(st.session_state.upload_digests):
+        if key[0] not in current:
+            del st.session_state.upload_digests[key]
+    for file_id in list(st.session_state.extraction_sources):
+        if file_id not in current:
+            _, name = st.session_state.extraction_sources.pop(file_id)
+            drop_result(name)
+
+def plan_extraction(uploaded_files, image_names, digests):
+    """把上传文件分为可以复用已有结果的和需要重新提取的，返回 (复用数量, 待提取的 [(文件, 名称)])
 
-# 旋转图像的函数
-def rotate_image(image, angle):
-    return image.rotate(angle, expand=True)
+    内容哈希相同的上传直接复用已有结果，名称改变时只重命名；内容改变的上传删除旧结果后重新提取。
+    """
+    sources = st.session_state.extraction_sources
+    reused = 0
+    pending = []
+    for uploaded_file in uploaded_files:
+        file_id = upload_id(uploaded_file)
+        digest = digests[file_id]
+        new_name = image_names[uploaded_file.name]
+        previous = sources.get(file_id)
+        if previous is not None and previous[0] == digest and previous[1] in st.session_state.extracted_images:
+            if previous[1] != new_name:
+                st.session_state.extracted_images[new_name] = st.session_state.extracted_images.pop(previous[1])
+                st.session_state.resized_images.pop(previous[1], None)
+                sources[file_id] = (digest, new_name)
+            reused += 1
+            continue
+        if previous is not None:
+            drop_result(previous[1])
+            del sources[file_id]
+        pending.append((uploaded_file, new_name))
+    return reused, pending
+
+drop_removed_uploads(uploaded_files)
 
 # Display all uploaded images
 if uploaded_files:
     st.subheader("Selected Images")
     cols = st.columns(10)  # Display 10 images per row
     image_names = {}  # To store user-inputted image names
+    digests = {}  # 每个上传文件的内容哈希，缩略图和增量提取共用
 
     for i, uploaded_file in enumerate(uploaded_files):
-        image = Image.open(uploaded_file)
+        digest = upload_digest(uploaded_file)
+        digests[upload_id(uploaded_file)] = digest
         with cols[i % 10]:  # Change row every 10 images
-            # Display thumbnail
-            st.image(image, caption=uploaded_file.name, use_column_width='auto', width=100)  # Thumbnail
+            # Display thumbnail：只发送缓存的小 JPEG，不再每次重新解码原图
+            st.image(get_thumbnail(uploaded_file.getvalue(), digest=digest), caption=uploaded_file.name, use_column_width='auto', width=100)  # Thumbnail
             
             # Input box for manually changing image name (without extension)
             default_name = uploaded_file.name.rsplit('.', 1)[0]
@@ -55,30 +136,39 @@ if uploaded_files:
     if st.sidebar.button("Extract Receipts"):
         # Show extracting indicator
         progress_bar = st.sidebar.progress(0)  # Initialize progress bar
-        total_images = len(uploaded_files)
-        st.write(f"Processing {total_images} images...")
+        st.session_state.metrics_recorder.reset()  # 每次提取开始一个新的批次报告
+        # 只提取新增或内容改变的上传，其余直接复用已有结果
+        reused, items = plan_extraction(uploaded_files, image_names, digests)
+        st.write(f"Processing {len(uploaded_files)} images: {reused} reused, {len(items)} to extract...")
+        file_ids = {new_name: (upload_id(uploaded_file), digests[upload_id(uploaded_file)]) for uploaded_file, new_name in items}
+        computed = 0
 
         with st.spinner("Extracting receipts..."):
-            for idx, uploaded_file in enumerate(uploaded_files):
-                # Use user-inputted new name
-                new_image_name = image_names[uploaded_file.name]
-                
+            def update_progress(value, current, total):
+                progress_bar.progress(value, text=f"{reused} reused, {current}/{total} computed")
+
+            # 相同的照片再次提取时直接读取磁盘缓存
+            extraction_cache = get_extraction_cache()
+            cache_before = extraction_cache.stats() if extraction_cache is not None else None
+
+            for new_image_name, extracted_image in detectAndCorrectReceipts(items, progress_callback=update_progress):
                 # 将提取后的发票保存到字典中
-                extracted_image = detectAndCorrectReceipt(uploaded_file, new_image_name)  # Pass the uploaded file and new name
                 if extracted_image is not None:
-                    # 将 PIL Image 转换为 bytes
-                    img_byte_arr = io.BytesIO()
-                    extracted_image.save(img_byte_arr, format='PNG')
-                    img_byte_arr = img_byte_arr.getvalue()
-                    st.session_state.extracted_images[new_image_name] = img_byte_arr  # Save to session state
+                    # 按配置的中间格式编码后保存
+                    st.session_state.extracted_images[new_image_name] = codec.encode(extracted_image)  # Save to session state
+                    file_id, digest = file_ids[new_image_name]
+                    st.session_state.extraction_sources[file_id] = (digest, new_image_name)
+                    computed += 1
                 else:
                     st.write(f"Failed to extract image: {new_image_name}")
 
-                # Update progress bar and percentage
-                progress = (idx + 1) / total_images
-                progress_bar.progress(progress)
-
-        st.sidebar.success(f"Receipts extracted successfully! Total: {len(st.session_state.extracted_images)}")
+        progress_bar.progress(100)
+        st.sidebar.success(f"Receipts extracted successfully! Total: {len(st.session_state.extracted_images)} "
+                           f"({reused} reused, {computed} computed)")
+        if extraction_cache is not None:
+            cache_after = extraction_cache.stats()
+            st.sidebar.caption(f"Cache: {cache_after['hits'] - cache_before['hits']} hits, "
+                               f"{cache_after['misses'] - cache_before['misses']} misses")
         st.write(f"Total extracted images: {len(st.session_state.extracted_images)}")
 
     # Display extracted images as thumbnails with delete button and rotation feature
@@ -86,32 +176,33 @@ if uploaded_files:
         st.subheader("Extracted Receipts")
         
         cols = st.columns(5)  # Display 5 images per row
-        for i, (name, img_bytes) in enumerate(list(st.session_state.extracted_images.items())):
+        for i, (name, stored_image) in enumerate(list(st.session_state.extracted_images.items())):
             with cols[i % 5]:
                 # Create a container for the image, delete button, and rotation slider
                 container = st.container()
                 # Add delete button
                 if container.button("X", key=f"delete_{name}"):
-                    del st.session_state.extracted_images[name]
+                    drop_result(name)
                     st.rerun()
                 
                 # Display thumbnail
                 try:
-                    img = Image.open(io.BytesIO(img_bytes))
-                    container.image(img, caption=name, use_column_width=True)
+                    digest = content_hash(stored_image)
+                    container.image(get_thumbnail(stored_image, digest=digest), caption=name, use_column_width=True)
                     
                     # Add rotation slider
                     rotation_angle = container.slider("Rotate", -180, 180, 0, key=f"rotate_{name}")
                     if rotation_angle != 0:
-                        rotated_img = rotate_image(img, rotation_angle)
-                        container.image(rotated_img, caption=f"{name} (Rotated)", use_column_width=True)
+                        # 预览只旋转缓存的小代理图，原图在保存时才旋转一次
+                        preview = get_thumbnail(stored_image, ROTATION_PREVIEW_MAX_SIDE, digest, rotation_angle)
+                        container.image(preview, caption=f"{name} (Rotated)", use_column_width=True)
                         
                         # Save button for rotated image
                         if container.button("Save Rotation", key=f"save_rotation_{name}"):
-                            # Convert rotated image to bytes and save to session state
-                            rotated_bytes = io.BytesIO()
-                            rotated_img.save(rotated_bytes, format='PNG')
-                            st.session_state.extracted_images[name] = rotated_bytes.getvalue()
+                            # 在原分辨率上旋转（90° 的倍数为无损转置）并保存到 session state
+                            st.session_state.extracted_images[name] = codec.encode(rotate_image(codec.decode(stored_image), rotation_angle))
+                            st.session_state.resized_images.pop(name, None)
+                            del st.session_state[f"rotate_{name}"]  # 保存后滑块回到 0
                             st.success(f"Rotated image saved for {name}")
                             st.rerun()
                 
@@ -128,16 +219,16 @@ if uploaded_files:
     if st.sidebar.button("Resize Images"):
         # Ensure resized_images exists
         st.session_state.resized_images.clear()  # Clear previous entries
+        exports.pop('pdf', None)  # PDF 中嵌入的是缩放后的图片
         
         if st.session_state.extracted_images:
-            for name, img_bytes in st.session_state.extracted_images.items():
-                img = Image.open(io.BytesIO(img_bytes))
-                resized_image = resize_image(img, scale_factor)  # Resize and get the resized image
-                # 将调整大小后的图像转换为 bytes
-                resized_img_byte_arr = io.BytesIO()
-                resized_image.save(resized_img_byte_arr, format='PNG')
-                resized_img_byte_arr = resized_img_byte_arr.getvalue()
-                st.session_state.resized_images[name] = resized_img_byte_arr  # Save resized image to session state
+            # 多线程快速缩放：先整数倍缩小，再用 LANCZOS 缩放剩余部分
+            items = list(st.session_state.extracted_images.items())
+            for name, resized_image in resize_batch(items, scale_factor, mode='fast', loader=codec.decode):
+                if resized_image is None:
+                    st.write(f"Failed to resize image: {name}")
+                    continue
+                st.session_state.resized_images[name] = codec.encode(resized_image)  # Save resized image to session state
 
             st.sidebar.success("Images resized successfully!")
             logging.info(f"Total resized images: {len(st.session_state.resized_images)}")
@@ -145,22 +236,29 @@ if uploaded_files:
     # Auto arrange
     if st.sidebar.button("Auto Arrange"):
         if st.session_state.resized_images:
-            # 将 bytes 转换回 PIL Image 对象
-            resized_images_pil = {name: Image.open(io.BytesIO(img_bytes)) for name, img_bytes in st.session_state.resized_images.items()}
-            arranged_pages = main(resized_images_pil)  # 现在可以正确调用 main 函数
+            # 排版只需要尺寸，不用解码；渲染和导出时才解码为 PIL Image 对象
+            pages = layout_images_cached([(name, stored.size) for name, stored in st.session_state.resized_images.items()])
+            # 渲染和导出时逐张解码，不同时把所有缩放后的图片解码到内存中
+            resized_images_pil = DecodedImages(st.session_state.resized_images, codec)
+
+            # 多进程并行渲染并编码为 PNG，按页码顺序返回，session_state 中只保存压缩后的页面，同样计入内存预算
+            arranged_pages = session_store.mapping('pages')
+            arranged_pages.clear()
+            for index, page_bytes in enumerate(render_pages_parallel(pages, resized_images_pil)):
+                arranged_pages[index] = EncodedImage('png', page_bytes, (A4_WIDTH, A4_HEIGHT), 'RGB')
             st.session_state.arranged_pages = arranged_pages
+            st.session_state.arranged_layout = pages
+            # 排版变化后旧的 PDF 失效，需要时再点击 "Prepare PDF" 重新生成
+            exports.pop('pdf', None)
+            print_layout_stats(pages)
             st.sidebar.success("Images arranged successfully!")
 
             # Display arranged results as thumbnails
             st.subheader("Arranged Results")
             cols = st.columns(5)  # Display 5 thumbnails per row
-            for i, page in enumerate(st.session_state.arranged_pages):
+            for i, stored_page in enumerate(st.session_state.arranged_pages.values()):
                 with cols[i % 5]:
-                    # 将 PIL Image 转换为 bytes
-                    img_byte_arr = io.BytesIO()
-                    page.save(img_byte_arr, format='PNG')
-                    img_byte_arr = img_byte_arr.getvalue()
-                    st.image(img_byte_arr, caption=f"Page {i+1}", use_column_width=True, width=200)  # Display thumbnail
+                    st.image(get_thumbnail(stored_page), caption=f"Page {i+1}", use_column_width=True, width=200)  # Display thumbnail
                 if (i + 1) % 5 == 0:
                     st.write("")  # Add a new line after every 5 thumbnails
         else:
@@ -170,8 +268,34 @@ else:
     st.sidebar.warning("Please upload images.")
 
 # 在页面底部显示 session_state 中的信息
+codec_stats = codec.stats()
+store_stats = session_store.stats()
+budget = f"{store_stats['budget_bytes'] / 1024 / 1024:.0f} MB budget" if store_stats['budget_bytes'] > 0 else "no budget"
+st.sidebar.caption(f"Session images ({codec_stats['format']}): {store_stats['resident_bytes'] / 1024 / 1024:.1f} MB resident "
+                   f"({budget}), {store_stats['spilled_bytes'] / 1024 / 1024:.1f} MB in {store_stats['spilled']} images "
+                   f"spilled to disk, encode {codec_stats['encode_seconds'] * 1000:.0f} ms ({codec_stats['encoded']}), "
+                   f"decode {codec_stats['decode_seconds'] * 1000:.0f} ms ({codec_stats['decoded']})")
 if 'arranged_pages' in st.session_state:
     st.write(f"Number of arranged pages: {len(st.session_state.arranged_pages)}")
+if collect_metrics:
+    with st.sidebar.expander("Metrics"):
+        metrics_report = st.session_state.metrics_recorder.report()
+        st.code(metrics.format_report(metrics_report) or "No stages recorded yet.")
+        st.download_button("Metrics (JSON)", data=metrics.to_json(metrics_report), file_name="metrics.json", mime="application/json")
+        st.download_button("Metrics (Prometheus)", data=metrics.to_prometheus(metrics_report), file_name="metrics.prom", mime="text/plain")
+if 'arranged_layout' in st.session_state:
+    # 直接导出多页 PDF：每张发票单独压缩嵌入，文件名为文字；排版没有变化时复用已生成的 PDF
+    if 'pdf' not in exports and st.sidebar.button("Prepare PDF"):
+        layout = st.session_state.arranged_layout
+        if all(name in st.session_state.resized_images for page in layout for name, _, _ in page):
+            pdf_buffer = io.BytesIO()
+            with metrics.span('export_pdf'):
+                export_pdf(layout, DecodedImages(st.session_state.resized_images, codec), pdf_buffer)
+            exports['pdf'] = EncodedBytes('pdf', pdf_buffer.getvalue())
+        else:
+            st.sidebar.warning("Images changed since the last arrangement, please arrange again.")
+    if 'pdf' in exports:
+        st.sidebar.download_button("Download PDF", data=exports['pdf'].data, file_name="receipts.pdf", mime="application/pdf")
 
 
 # 尝试显示第一张提取的图片（如果有的话）
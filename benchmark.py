@@ -0,0 +1,462 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# 各模块的导入时间预算（秒），在全新的解释器中测量
+IMPORT_TIME_BUDGETS = {
+    'process_receipt': 2.0,
+    'layout_images': 0.5,
+    'resize': 2.0,
+    'cli': 2.0,
+}
+
+# 基准测试套件的基线结果文件，以及判定为性能退化的阈值（比基线慢或多占用内存超过该比例）
+BASELINE_PATH = 'benchmark_baseline.json'
+REGRESSION_TOLERANCE = 0.25
+
+# 峰值内存低于该值（字节）时不比较，避免小数值的抖动被误判为退化
+MIN_COMPARED_PEAK = 1024 * 1024
+
+# layout 子命令的默认发票数量；grid 引擎逐像素扫描，未显式指定 --engines 时只在不超过 GRID_MAX_COUNT 张时运行
+LAYOUT_COUNTS = [50, 200, 1000]
+LAYOUT_ENGINES = ['grid', 'bitmap', 'maxrects']
+GRID_MAX_COUNT = 200
+
+# 这些重量级依赖不应该在导入阶段被加载
+FORBIDDEN_IMPORTS = ['easyocr', 'torch', 'streamlit', 'PyQt5']
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+def measure_import_time(module, repeat=3):
+    """在全新的子进程中导入模块，返回最短耗时和被意外加载的重量级依赖"""
+    best = float('inf')
+    loaded = []
+    code = IMPORT_PROBE.format(module=module, forbidden=FORBIDDEN_IMPORTS)
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        best = min(best, result['elapsed'])
+        loaded = result['loaded']
+    return best, loaded
+
+def check_import_times(budgets=None, repeat=3):
+    """检查导入时间是否超出预算，全部通过时返回 True"""
+    budgets = budgets or IMPORT_TIME_BUDGETS
+    ok = True
+    for module, budget in budgets.items():
+        elapsed, loaded = measure_import_time(module, repeat)
+        status = 'OK'
+        if elapsed > budget:
+            status = 'FAIL'
+            ok = False
+        if loaded:
+            status = 'FAIL'
+            ok = False
+        print(f"{module:<20} {elapsed:.3f}s / {budget:.3f}s  {status}")
+        if loaded:
+            print(f"  导入时加载了重量级依赖: {', '.join(loaded)}")
+    return ok
+
+def time_call(function, *args, repeat=3, **kwargs):
+    """多次调用函数，返回 (最短耗时秒数, 最后一次的返回值)"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def bench_detection(image_paths, proxy_max_side=None, repeat=3):
+    """对比原图检测和代理图检测的耗时，以及两者角点的最大偏差"""
+    import cv2
+    import numpy as np
+    from process_receipt import DETECT_PROXY_MAX_SIDE, detect_receipt_corners
+
+    proxy_max_side = proxy_max_side or DETECT_PROXY_MAX_SIDE
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"{path}: 无法读取")
+            continue
+        full_time, full = time_call(detect_receipt_corners, image, None, repeat=repeat)
+        proxy_time, proxy = time_call(detect_receipt_corners, image, proxy_max_side, repeat=repeat)
+        if full is None or proxy is None:
+            print(f"{path}: 未检测到发票轮廓")
+            continue
+        deviation = float(np.max(np.linalg.norm(full[0] - proxy[0], axis=1)))
+        height, width = image.shape[:2]
+        print(f"{path} ({width}x{height}): full {full_time * 1000:.1f} ms, "
+              f"proxy {proxy_time * 1000:.1f} ms ({full_time / proxy_time:.1f}x), "
+              f"max corner deviation {deviation:.1f}px")
+
+def measure_peak_memory(function, *args, **kwargs):
+    """用 tracemalloc 测量一次调用期间的峰值内存（字节），NumPy/OpenCV 的数组分配也会被计入"""
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def legacy_decode(image_bytes):
+    """旧的读取路径：PIL 解码、拷贝到 NumPy、多次颜色转换，最后再转回 PIL"""
+    import io
+    import cv2
+    import numpy as np
+    from PIL import Image
+
+    image_np = np.array(Image.open(io.BytesIO(image_bytes)))
+    if len(image_np.shape) == 3 and image_np.shape[2] == 4:
+        image_np = cv2.cvtColor(image_np, cv2.COLOR_RGBA2RGB)
+    image_cv = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
+    cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
+    return Image.fromarray(cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB))
+
+def fast_decode(image_bytes):
+    """新的读取路径：imdecode 一次解码为 BGR，PIL 转换时只拷贝一次"""
+    import io
+    from process_receipt import bgr_to_pil, decode_image, read_image_buffer
+
+    return bgr_to_pil(decode_image(read_image_buffer(io.BytesIO(image_bytes))))
+
+def bench_ingest(image_paths, repeat=3):
+    """对比旧的和新的图片读取路径的耗时和峰值内存"""
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            image_bytes = f.read()
+        for label, decode in (('legacy', legacy_decode), ('imdecode', fast_decode)):
+            elapsed, _ = time_call(decode, image_bytes, repeat=repeat)
+            peak = measure_peak_memory(decode, image_bytes)
+            print(f"{path} [{label}]: {elapsed * 1000:.1f} ms, peak {peak / 1024 / 1024:.1f} MB")
+
+def bench_orientation(image_paths, repeat=3, tolerance=5):
+    """对比逐轮廓和向量化两种方向估计的单张耗时，并检查角度是否在容差内一致"""
+    import cv2
+    from utils import detectTextOrientation, detectTextOrientationContours
+
+    mismatches = 0
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"{path}: 无法读取")
+            continue
+        contour_time, contour_angle = time_call(detectTextOrientationContours, image, repeat=repeat)
+        vector_time, vector_angle = time_call(detectTextOrientation, image, repeat=repeat)
+        status = 'OK' if abs(contour_angle - vector_angle) <= tolerance else 'MISMATCH'
+        if status != 'OK':
+            mismatches += 1
+        print(f"{path}: contours {contour_time * 1000:.1f} ms ({contour_angle}°), "
+              f"vectorized {vector_time * 1000:.1f} ms ({vector_angle}°)  {status}")
+    return mismatches == 0
+
+def random_receipt_sizes(count, seed=0):
+    """生成随机的发票尺寸（缩放后的像素），用于排版基准测试"""
+    import random
+    rng = random.Random(seed)
+    return [(f"receipt_{i:05d}.png", (rng.randint(150, 900), rng.randint(200, 1400))) for i in range(count)]
+
+def bench_layout(counts, engines, modes=('single',), repeat=1, folder=None, grid_max_count=None):
+    """对比各排版引擎和排列方式在不同数量发票下的耗时、页数和平均填充率
+
+    指定 folder 时使用文件夹中真实图片的尺寸。single 模式下检查 bitmap 与 grid 的结果是否一致。
+    grid_max_count 不为 None 时，发票数量超过该值的批次跳过 grid 引擎。
+    """
+    from layout_images import get_image_sizes, layout_images, layout_stats
+
+    batches = [(len(get_image_sizes(folder)), get_image_sizes(folder))] if folder else \
+        [(count, random_receipt_sizes(count)) for count in counts]
+
+    ok = True
+    for count, sizes in batches:
+        for mode in modes:
+            results = {}
+            for engine in engines:
+                if engine == 'grid' and grid_max_count is not None and count > grid_max_count:
+                    continue
+                elapsed, pages = time_call(lambda: layout_images(list(sizes), engine, mode=mode), repeat=repeat)
+                results[engine] = pages
+                stats = layout_stats(pages)
+                fill = sum(page['fill_ratio'] for page in stats) / max(1, len(stats))
+                print(f"{count:>6} receipts [{engine:<8} {mode:<9}]: {elapsed * 1000:.1f} ms, "
+                      f"{len(pages)} pages, average fill {fill:.1%}")
+            if mode == 'single' and 'grid' in results and 'bitmap' in results:
+                same = results['grid'] == results['bitmap']
+                ok = ok and same
+                print(f"{count:>6} receipts: bitmap {'matches' if same else 'DIFFERS FROM'} grid")
+    return ok
+
+def psnr(reference, image):
+    """两张同尺寸图片之间的峰值信噪比（dB），完全相同时为 inf"""
+    import numpy as np
+    reference = np.asarray(reference.convert('RGB'), dtype=np.float64)
+    image = np.asarray(image.convert('RGB'), dtype=np.float64)
+    mse = np.mean((reference - image) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+def bench_resize(image_paths, scale_factors, repeat=3, min_psnr=35.0):
+    """对比整图 LANCZOS 和快速缩放路径的耗时，以快速路径相对 LANCZOS 结果的 PSNR 衡量质量"""
+    from resize import open_resized
+
+    ok = True
+    for path in image_paths:
+        for scale_factor in scale_factors:
+            quality_time, reference = time_call(open_resized, path, scale_factor, 'quality', repeat=repeat)
+            fast_time, fast = time_call(open_resized, path, scale_factor, 'fast', repeat=repeat)
+            value = psnr(reference, fast)
+            status = 'OK' if value >= min_psnr else 'LOW'
+            ok = ok and value >= min_psnr
+            print(f"{path} x{scale_factor}: lanczos {quality_time * 1000:.1f} ms, fast {fast_time * 1000:.1f} ms "
+                  f"({quality_time / fast_time:.1f}x), PSNR {value:.1f} dB  {status}")
+    return ok
+
+def bench_intermediate(image_paths, formats, repeat=3):
+    """对比各中间格式的编码、解码耗时和占用字节数"""
+    from PIL import Image
+    from image_store import encode_image
+
+    for path in image_paths:
+        with Image.open(path) as img:
+            image = img.convert('RGB')
+        for format in formats:
+            encode_time, encoded = time_call(encode_image, image, format, repeat=repeat)
+            decode_time, _ = time_call(encoded.open, repeat=repeat)
+            print(f"{path} [{format:<4}]: {encoded.nbytes / 1024 / 1024:.2f} MB, "
+                  f"encode {encode_time * 1000:.1f} ms, decode {decode_time * 1000:.1f} ms")
+
+def measure_stage(function, repeat=3):
+    """测量一个阶段的最短耗时和峰值内存，返回 {'seconds', 'peak_bytes'}
+
+    峰值内存来自 tracemalloc，只包含 Python 和 NumPy 的分配，PIL 内部的像素缓冲区不计入。
+    """
+    elapsed, _ = time_call(function, repeat=repeat)
+    return {'seconds': elapsed, 'peak_bytes': measure_peak_memory(function)}
+
+def bench_stages(resolutions, repeat=3):
+    """在合成照片上分别测量解码、轮廓检测、提取、方向检测和缩放各阶段"""
+    import io
+    import cv2
+    from process_receipt import bgr_to_pil, decode_image, detect_receipt_corners, extract_receipt, read_image_buffer
+    from resize import open_resized
+    from synthetic import RESOLUTIONS, make_receipt_photo
+    from utils import detectTextOrientation
+
+    results = {}
+    for name in resolutions:
+        photo, _ = make_receipt_photo(RESOLUTIONS[name], rotation=90, seed=1)
+        encoded = cv2.imencode('.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+        image = decode_image(read_image_buffer(io.BytesIO(encoded)))
+        extracted = extract_receipt(image, 'benchmark')
+        if extracted is None:
+            raise RuntimeError(f"No receipt detected in the synthetic {name} photo")
+        receipt = extracted[0]
+        receipt_pil = bgr_to_pil(receipt)
+
+        stages = {
+            'decode': lambda: decode_image(read_image_buffer(io.BytesIO(encoded))),
+            'detect': lambda: detect_receipt_corners(image),
+            'extract': lambda: extract_receipt(image, 'benchmark'),
+            'orientation': lambda: detectTextOrientation(receipt),
+            'resize': lambda: open_resized(receipt_pil, 0.3, 'fast'),
+        }
+        for stage, function in stages.items():
+            results[f"{stage}@{name}"] = measure_stage(function, repeat)
+    return results
+
+def bench_pages(batch_sizes, repeat=3):
+    """测量不同数量发票的排版和整页渲染（含 PNG 编码）"""
+    import numpy as np
+    from PIL import Image
+    from layout_images import encode_page, layout_images, save_pages
+    from synthetic import make_receipt
+
+    template = Image.fromarray(make_receipt(np.random.default_rng(0))[:, :, ::-1])
+    results = {}
+    for count in batch_sizes:
+        sizes = random_receipt_sizes(count)
+        images = {filename: template.resize(size) for filename, size in sizes}
+        pages = layout_images(list(sizes))
+        results[f"layout@{count}"] = measure_stage(lambda: layout_images(list(sizes)), repeat)
+        results[f"render@{count}"] = measure_stage(lambda: save_pages(pages, images, lambda index, canvas: len(encode_page(canvas))), 1)
+    return results
+
+def bench_end_to_end(batch_sizes, resolution='8mp', max_workers=None, scale_factor=0.3):
+    """文件夹到页面的完整流程：提取、缩放、排版、渲染，记录总耗时和每秒处理的图片数
+
+    进程池中子进程的内存不计入 tracemalloc，峰值内存只反映主进程。
+    """
+    import tempfile
+    from layout_images import layout_images, save_pages
+    from process_receipt import extractReceiptsFromFolder
+    from resize import resize_batch
+    from synthetic import RESOLUTIONS, generate_dataset
+
+    results = {}
+    for count in batch_sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            generate_dataset(folder, count, RESOLUTIONS[resolution])
+            receipts_folder = os.path.join(folder, 'receipts')
+            pages_folder = os.path.join(folder, 'pages')
+
+            def run():
+                extractReceiptsFromFolder(folder, receipts_folder, max_workers, cache=False)
+                items = [(filename, os.path.join(receipts_folder, filename)) for filename in sorted(os.listdir(receipts_folder))]
+                resized = dict(resize_batch(items, scale_factor, mode='fast'))
+                pages = layout_images([(filename, img.size) for filename, img in resized.items()])
+                save_pages(pages, resized, pages_folder)
+
+            result = measure_stage(run, repeat=1)
+            result['images_per_second'] = count / result['seconds']
+            results[f"end_to_end@{count}x{resolution}"] = result
+    return results
+
+def compare_with_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """打印结果与基线的对比表，存在退化时返回 False"""
+    ok = True
+    for key, result in results.items():
+        reference = baseline.get(key)
+        line = f"{key:<24} {result['seconds'] * 1000:>10.1f} ms {result['peak_bytes'] / 1024 / 1024:>8.1f} MB"
+        if 'images_per_second' in result:
+            line += f" {result['images_per_second']:>7.2f} img/s"
+        if reference is None:
+            print(f"{line}  (no baseline)")
+            continue
+        time_ratio = result['seconds'] / reference['seconds']
+        status = 'OK'
+        if time_ratio > 1 + tolerance:
+            status = 'REGRESSION (time)'
+        elif (reference['peak_bytes'] >= MIN_COMPARED_PEAK and
+              result['peak_bytes'] > reference['peak_bytes'] * (1 + tolerance)):
+            status = 'REGRESSION (memory)'
+        ok = ok and status == 'OK'
+        print(f"{line}  {time_ratio - 1:+7.1%} vs baseline  {status}")
+    return ok
+
+def run_suite(resolutions, batch_sizes, end_to_end_sizes, end_to_end_resolution, repeat=3, max_workers=None,
+              baseline_path=BASELINE_PATH, save_baseline=False, tolerance=REGRESSION_TOLERANCE):
+    """运行完整的基准测试套件，与基线比较；save_baseline 时把本次结果写为新的基线
+
+    基线与机器相关，应在同一台机器上生成和比较，因此仓库中不附带基线。没有基线文件时返回 False，
+    避免在没有任何比较的情况下显示为通过；第一次运行时使用 save_baseline 生成基线。
+    """
+    has_baseline = os.path.exists(baseline_path)
+    if not has_baseline and not save_baseline:
+        print(f"WARNING: baseline {baseline_path} not found, nothing to compare against. "
+              f"Run with --save-baseline on this machine first.")
+
+    results = {}
+    results.update(bench_stages(resolutions, repeat))
+    results.update(bench_pages(batch_sizes, repeat))
+    results.update(bench_end_to_end(end_to_end_sizes, end_to_end_resolution, max_workers))
+
+    baseline = {}
+    if has_baseline:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    ok = compare_with_baseline(results, baseline, tolerance)
+
+    if save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                       'cpu_count': os.cpu_count(), 'results': results}, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+        return True
+    if not has_baseline:
+        print(f"FAILED: no baseline at {baseline_path}; run with --save-baseline to create one")
+        return False
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Receipt pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import-time', help="检查模块导入时间是否超出预算")
+    import_parser.add_argument('--repeat', type=int, default=3)
+    import_parser.add_argument('--budget', type=float, default=None, help="统一覆盖所有模块的预算（秒）")
+
+    detect_parser = subparsers.add_parser('detect', help="对比原图和代理图上的发票轮廓检测")
+    detect_parser.add_argument('images', nargs='+')
+    detect_parser.add_argument('--proxy-max-side', type=int, default=None)
+    detect_parser.add_argument('--repeat', type=int, default=3)
+
+    ingest_parser = subparsers.add_parser('ingest', help="对比旧的和新的图片读取路径")
+    ingest_parser.add_argument('images', nargs='+')
+    ingest_parser.add_argument('--repeat', type=int, default=3)
+
+    orientation_parser = subparsers.add_parser('orientation', help="对比两种文字方向估计的耗时和结果")
+    orientation_parser.add_argument('images', nargs='+', help="已提取的发票图片")
+    orientation_parser.add_argument('--repeat', type=int, default=3)
+
+    layout_parser = subparsers.add_parser('layout', help="对比各排版引擎的耗时")
+    layout_parser.add_argument('--counts', type=int, nargs='+', default=LAYOUT_COUNTS)
+    layout_parser.add_argument('--engines', nargs='+', default=None,
+                               help=f"默认为 {' '.join(LAYOUT_ENGINES)}，此时 grid 只运行不超过 {GRID_MAX_COUNT} 张的批次")
+    layout_parser.add_argument('--modes', nargs='+', default=['single', 'first_fit', 'best_fit'])
+    layout_parser.add_argument('--folder', default=None, help="使用文件夹中真实图片的尺寸")
+    layout_parser.add_argument('--repeat', type=int, default=1)
+
+    resize_parser = subparsers.add_parser('resize', help="对比 LANCZOS 和快速缩放的耗时和质量")
+    resize_parser.add_argument('images', nargs='+')
+    resize_parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 0.3, 0.15])
+    resize_parser.add_argument('--repeat', type=int, default=3)
+    resize_parser.add_argument('--min-psnr', type=float, default=35.0)
+
+    intermediate_parser = subparsers.add_parser('intermediate', help="对比会话中间图片格式的大小和编解码耗时")
+    intermediate_parser.add_argument('images', nargs='+')
+    intermediate_parser.add_argument('--formats', nargs='+', default=['raw', 'png', 'webp'])
+    intermediate_parser.add_argument('--repeat', type=int, default=3)
+
+    suite_parser = subparsers.add_parser('suite', help="在合成照片上测量各阶段和完整流程，并与基线比较")
+    suite_parser.add_argument('--resolutions', nargs='+', default=['2mp', '12mp'])
+    suite_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[20, 100])
+    suite_parser.add_argument('--end-to-end-sizes', type=int, nargs='+', default=[8])
+    suite_parser.add_argument('--end-to-end-resolution', default='8mp')
+    suite_parser.add_argument('--workers', type=int, default=None)
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--baseline', default=BASELINE_PATH)
+    suite_parser.add_argument('--save-baseline', action='store_true', help="把本次结果保存为新的基线（没有基线时必须先运行一次）")
+    suite_parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'import-time':
+        budgets = None
+        if args.budget is not None:
+            budgets = {module: args.budget for module in IMPORT_TIME_BUDGETS}
+        return 0 if check_import_times(budgets, args.repeat) else 1
+    if args.command == 'detect':
+        bench_detection(args.images, args.proxy_max_side, args.repeat)
+        return 0
+    if args.command == 'ingest':
+        bench_ingest(args.images, args.repeat)
+        return 0
+    if args.command == 'orientation':
+        return 0 if bench_orientation(args.images, args.repeat) else 1
+    if args.command == 'layout':
+        # 只有显式指定 --engines 时才让 grid 运行大批次
+        grid_max_count = None if args.engines else GRID_MAX_COUNT
+        return 0 if bench_layout(args.counts, args.engines or LAYOUT_ENGINES, args.modes, args.repeat, args.folder,
+                                 grid_max_count) else 1
+    if args.command == 'resize':
+        return 0 if bench_resize(args.images, args.scales, args.repeat, args.min_psnr) else 1
+    if args.command == 'suite':
+        ok = run_suite(args.resolutions, args.batch_sizes, args.end_to_end_sizes, args.end_to_end_resolution,
+                       args.repeat, args.workers, args.baseline, args.save_baseline, args.tolerance)
+        return 0 if ok else 1
+    if args.command == 'intermediate':
+        bench_intermediate(args.images, args.formats, args.repeat)
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
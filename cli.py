@@ -0,0 +1,140 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+# 命令行入口：输入文件夹 → 提取（同时缩放）→ 排版 → 渲染，不导入 Qt 和 Streamlit
+from process_receipt import IMAGE_EXTENSIONS, detectAndCorrectReceipts
+from layout_images import DEFAULT_LAYOUT_MODE, DEFAULT_PACKING_ENGINE, LAYOUT_MODES, layout_images, print_layout_stats, render_pages_parallel
+from packing import PACKERS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 默认输出格式：'png' 为逐页 PNG，'pdf' 为单个多页 PDF
+OUTPUT_FORMATS = ('png', 'pdf')
+DEFAULT_SCALE_FACTOR = 0.3
+
+def list_images(input_folder):
+    """输入文件夹中的图片，按文件名排序"""
+    return sorted(f for f in os.listdir(input_folder) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+def run(input_folder, output_folder=None, max_workers=None, scale_factor=DEFAULT_SCALE_FACTOR, formats=('png',),
+        engine=DEFAULT_PACKING_ENGINE, mode=DEFAULT_LAYOUT_MODE, use_cache=True, progress=True):
+    """执行完整流程并返回统计信息
+
+    提取时直接输出缩放后的发票（透视、旋转和缩放只重采样一次），结果在内存中流式累积，
+    不写 receipts/ 和 resize/ 中间文件夹；页面渲染完成一页写出一页。
+    """
+    if output_folder is None:
+        output_folder = os.path.join(input_folder, 'output')
+    os.makedirs(output_folder, exist_ok=True)
+
+    image_files = list_images(input_folder)
+    items = [(os.path.join(input_folder, f), f.rsplit('.', 1)[0]) for f in image_files]
+    start = time.perf_counter()
+
+    def report_progress(value, current, total):
+        if progress:
+            print(f"\rExtracting {current}/{total} ({value}%)", end='', file=sys.stderr, flush=True)
+
+    resized_images = {}
+    failed = []
+    for new_image_name, image in detectAndCorrectReceipts(items, max_workers, report_progress, scale_factor=scale_factor,
+                                                          cache=None if use_cache else False):
+        if image is None:
+            failed.append(new_image_name)
+            continue
+        resized_images[f"{new_image_name}.png"] = image
+    if progress and items:
+        print(file=sys.stderr)
+    extract_seconds = time.perf_counter() - start
+
+    pages = layout_images([(filename, img.size) for filename, img in resized_images.items()], engine, mode=mode)
+    print_layout_stats(pages)
+
+    outputs = []
+    if 'png' in formats:
+        for index, data in enumerate(render_pages_parallel(pages, resized_images, max_workers)):
+            path = os.path.join(output_folder, f"page_{index + 1}.png")
+            with open(path, 'wb') as f:
+                f.write(data)
+            outputs.append(path)
+            if progress:
+                print(f"\rRendering {index + 1}/{len(pages)}", end='', file=sys.stderr, flush=True)
+        if progress and pages:
+            print(file=sys.stderr)
+    if 'pdf' in formats:
+        from pdf_export import export_pdf
+        path = os.path.join(output_folder, 'receipts.pdf')
+        with metrics.span('export_pdf'):
+            export_pdf(pages, resized_images, path)
+        outputs.append(path)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'images': len(items),
+        'extracted': len(resized_images),
+        'failed': failed,
+        'pages': len(pages),
+        'outputs': outputs,
+        'extract_seconds': extract_seconds,
+        'seconds': elapsed,
+        'images_per_second': len(items) / elapsed if elapsed > 0 else 0.0,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract, resize and arrange receipt photos without a GUI")
+    parser.add_argument('input_folder')
+    parser.add_argument('-o', '--output', default=None, help="输出文件夹（默认为 input_folder/output）")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="并行进程数（默认为 CPU 核数）")
+    parser.add_argument('-s', '--scale', type=float, default=DEFAULT_SCALE_FACTOR, help="发票相对原图的缩放比例")
+    parser.add_argument('-f', '--format', nargs='+', choices=OUTPUT_FORMATS, default=['png'], help="输出格式")
+    parser.add_argument('--engine', choices=list(PACKERS), default=DEFAULT_PACKING_ENGINE)
+    parser.add_argument('--mode', choices=LAYOUT_MODES, default=DEFAULT_LAYOUT_MODE)
+    parser.add_argument('--no-cache', action='store_true', help="不使用磁盘上的提取缓存")
+    parser.add_argument('--metrics', default=None, help="保存各阶段统计（.json 或 Prometheus 文本）")
+    parser.add_argument('--watch', action='store_true', help="持续监视输入文件夹，只处理新增或改变的图片")
+    parser.add_argument('--interval', type=float, default=None, help="监视模式的扫描间隔（秒）")
+    parser.add_argument('-q', '--quiet', action='store_true', help="不显示进度")
+    parser.add_argument('-v', '--verbose', action='store_true', help="显示每张图片的处理日志")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_folder):
+        parser.error(f"Input folder does not exist: {args.input_folder}")
+    if not 0 < args.scale <= 1:
+        parser.error("Scale factor must be between 0 and 1")
+
+    # process_receipt 导入时把日志级别设为 INFO，命令行默认只显示警告
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    if args.metrics:
+        metrics.enable()
+
+    if args.watch:
+        # 监视模式使用输出文件夹中的清单做增量处理，只输出逐页 PNG
+        from watch import DEFAULT_INTERVAL, watch_folder
+        watch_folder(args.input_folder, args.output, args.interval or DEFAULT_INTERVAL, args.workers, args.scale,
+                     args.engine, args.mode)
+        if args.metrics:
+            metrics.save_report(args.metrics)
+        return 0
+
+    result = run(args.input_folder, args.output, args.workers, args.scale, args.format, args.engine, args.mode,
+                 use_cache=not args.no_cache, progress=not args.quiet)
+
+    for name in result['failed']:
+        print(f"Failed to process image: {name}")
+    for path in result['outputs']:
+        print(f"Wrote {path}")
+    print(f"Processed {result['extracted']}/{result['images']} images into {result['pages']} pages "
+          f"in {result['seconds']:.2f}s ({result['images_per_second']:.2f} images/s, "
+          f"extraction {result['extract_seconds']:.2f}s)")
+
+    if args.metrics:
+        metrics.save_report(args.metrics)
+        print(metrics.format_report())
+    return 0 if not result['failed'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 缓存目录和容量上限，可以通过环境变量覆盖
+CACHE_DIR = os.environ.get('RECEIPT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'invoice_adjust', 'extract'))
+CACHE_MAX_BYTES = int(os.environ.get('RECEIPT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# RECEIPT_CACHE=0 时关闭默认缓存
+CACHE_ENABLED = os.environ.get('RECEIPT_CACHE', '1') != '0'
+
+# 提取流程的版本号，提取算法的输出发生变化时需要加一，使旧的缓存失效
+PIPELINE_VERSION = 2
+
+# 缓存的发票使用快速的 PNG 压缩级别，读写都比默认级别快
+PNG_COMPRESS_LEVEL = 1
+
+class ExtractionCache:
+    """以输入字节和流程参数的哈希为键的磁盘缓存
+
+    每个条目保存提取出的发票（PNG）和检测到的角点、旋转角度（JSON）。读取时更新文件的修改时间，
+    总大小超过 max_bytes 时按条目最近一次使用的时间从旧到新删除（LRU），同一条目的两个文件一起删除。
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._total_bytes = None
+
+    @staticmethod
+    def make_key(image_buffer, params):
+        """输入字节 + 流程参数 + 版本号的 SHA-256"""
+        digest = hashlib.sha256(image_buffer)
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        digest.update(f"v{PIPELINE_VERSION}".encode('ascii'))
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        folder = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(folder, f"{key}.png"), os.path.join(folder, f"{key}.json")
+
+    def get(self, key):
+        """返回 (PIL 图像, 元数据)；未命中时返回 None"""
+        image_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            image = Image.open(image_path)
+            image.load()
+            os.utime(image_path)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return image, meta
+
+    @staticmethod
+    def _write_atomic(path, write):
+        """用唯一的临时文件写入再重命名，多个进程同时写同一个条目时不会互相覆盖半个文件"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def put(self, key, image, meta):
+        """写入一个条目；先写图片再写元数据，get() 先读元数据，中途崩溃不会读到半个条目"""
+        image_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        try:
+            self._write_atomic(image_path, lambda f: image.save(f, format='PNG', compress_level=PNG_COMPRESS_LEVEL))
+            self._write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        except OSError as e:
+            logger.warning(f"Failed to write extraction cache entry {key}: {str(e)}")
+            return
+        with self.lock:
+            if self._total_bytes is not None:
+                self._total_bytes += os.path.getsize(image_path) + os.path.getsize(meta_path)
+        self.evict()
+
+    def _entries(self):
+        """按条目（文件名去掉扩展名）汇总，返回 [(最近修改时间, 总大小, [路径])]
+
+        缺少图片或元数据的残缺条目和遗留的临时文件也各自作为一个条目，随 LRU 一起被清理。
+        """
+        groups = {}
+        if not os.path.isdir(self.cache_dir):
+            return []
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                group = groups.setdefault(os.path.join(folder.path, entry.name.split('.', 1)[0]), [0.0, 0, []])
+                group[0] = max(group[0], stat.st_mtime)
+                group[1] += stat.st_size
+                group[2].append(entry.path)
+        return [tuple(group) for group in groups.values()]
+
+    def evict(self):
+        """总大小超过上限时按 LRU 删除条目，同一条目的图片和元数据一起删除"""
+        with self.lock:
+            if self._total_bytes is not None and self._total_bytes <= self.max_bytes:
+                return
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                for _, size, paths in sorted(entries):
+                    # 先删元数据，get() 读不到元数据时视为未命中，不会只读到图片
+                    for path in sorted(paths, key=lambda path: not path.endswith('.json')):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+            self._total_bytes = total
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            for _, _, paths in self._entries():
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_extraction_cache():
+    """进程内共享的默认缓存，缓存被关闭时返回 None"""
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ExtractionCache()
+    return _default_cache
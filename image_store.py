@@ -0,0 +1,410 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# 会话中保存中间图片（提取结果、缩放结果）的格式，按部署通过环境变量选择：
+#   'raw'  未压缩的像素数据和尺寸、模式信息，没有编解码开销，占用内存最多
+#   'png'  最快压缩级别的 PNG
+#   'webp' 无损 WebP，体积最小，编码比 PNG 慢
+INTERMEDIATE_FORMATS = ('raw', 'png', 'webp')
+INTERMEDIATE_FORMAT = os.environ.get('RECEIPT_INTERMEDIATE_FORMAT', 'png')
+
+PNG_COMPRESS_LEVEL = 1
+
+# 每个会话中间图片的常驻内存预算（MB），超出后把最久未使用的图片写到临时目录，用到时再从磁盘读取；
+# 0 表示不限制
+MEMORY_BUDGET_MB = float(os.environ.get('RECEIPT_MEMORY_BUDGET_MB', '512'))
+
+# 溢出文件的根目录，每个会话在其中创建一个子目录
+SCRATCH_DIR = os.environ.get('RECEIPT_SCRATCH_DIR', os.path.join(tempfile.gettempdir(), 'invoice_adjust_scratch'))
+
+# 每个会话目录中的锁文件，会话存在期间一直持有；进程退出（包括崩溃）时由系统释放
+SCRATCH_LOCK_NAME = 'owner.lock'
+
+# 无法通过锁文件判断（没有锁文件或锁文件为空）且超过该秒数没有修改的会话目录视为遗留的，新会话开始时删除
+SCRATCH_MAX_AGE = 24 * 3600
+
+def image_digest(format, data, size, mode):
+    """编码后图片的 SHA-256，包含格式、模式和尺寸（raw 数据本身不含这些信息）"""
+    digest = hashlib.sha256(f"{format}:{mode}:{size}".encode('ascii'))
+    digest.update(data)
+    return digest.hexdigest()
+
+class EncodedImage:
+    """会话中保存的一张图片：编码后的数据加上解码需要的尺寸和模式
+
+    digest 在编码时计算一次，溢出到磁盘时随图片一起保留，页面每次运行取缩略图缓存键时不必重新读取数据。
+    """
+
+    __slots__ = ('format', 'data', 'size', 'mode', '_digest')
+
+    # 是否已经溢出到磁盘，溢出的条目不计入常驻内存
+    spilled = False
+
+    def __init__(self, format, data, size, mode, digest=None):
+        self.format = format
+        self.data = data
+        self.size = size
+        self.mode = mode
+        self._digest = digest
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = image_digest(self.format, self.data, self.size, self.mode)
+        return self._digest
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def open(self):
+        """解码为 PIL 图像"""
+        if self.format == 'raw':
+            return Image.frombytes(self.mode, self.size, self.data)
+        img = Image.open(io.BytesIO(self.data))
+        img.load()
+        return img
+
+    def spill(self, path):
+        """数据已经写入 path 后，返回替代本对象的 SpilledImage"""
+        return SpilledImage(path, self.format, self.size, self.mode, self.digest)
+
+class EncodedBytes:
+    """会话中保存的非图片数据（例如导出的 PDF）：只有格式和字节，与图片共用内存预算，不能解码为图像"""
+
+    __slots__ = ('format', 'data', '_digest')
+
+    spilled = False
+
+    def __init__(self, format, data, digest=None):
+        self.format = format
+        self.data = data
+        self._digest = digest
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            digest = hashlib.sha256(f"{self.format}:".encode('ascii'))
+            digest.update(self.data)
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+    def spill(self, path):
+        return SpilledBytes(path, self.format, self.digest)
+
+def encode_image(image, format=INTERMEDIATE_FORMAT):
+    """把 PIL 图像编码为 EncodedImage"""
+    if format == 'raw':
+        data = image.tobytes()
+    elif format == 'png':
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        data = buffer.getvalue()
+    elif format == 'webp':
+        # 无损模式下 quality 表示压缩力度，0 最快
+        buffer = io.BytesIO()
+        image.save(buffer, format='WEBP', lossless=True, quality=0, method=0)
+        data = buffer.getvalue()
+    else:
+        raise ValueError(f"Unknown intermediate format: {format}. Available: {', '.join(INTERMEDIATE_FORMATS)}")
+    return EncodedImage(format, data, image.size, image.mode, image_digest(format, data, image.size, image.mode))
+
+class ImageCodec:
+    """按配置的格式编解码中间图片，并累计编解码耗时，供页面显示"""
+
+    def __init__(self, format=INTERMEDIATE_FORMAT):
+        if format not in INTERMEDIATE_FORMATS:
+            raise ValueError(f"Unknown intermediate format: {format}. Available: {', '.join(INTERMEDIATE_FORMATS)}")
+        self.format = format
+        self.encode_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.encoded = 0
+        self.decoded = 0
+        self.lock = threading.Lock()
+
+    def encode(self, image):
+        start = time.perf_counter()
+        encoded = encode_image(image, self.format)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.encode_seconds += elapsed
+            self.encoded += 1
+        return encoded
+
+    def decode(self, encoded):
+        start = time.perf_counter()
+        image = encoded.open()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.decode_seconds += elapsed
+            self.decoded += 1
+        return image
+
+    def stats(self):
+        with self.lock:
+            return {'format': self.format, 'encoded': self.encoded, 'decoded': self.decoded,
+                    'encode_seconds': self.encode_seconds, 'decode_seconds': self.decode_seconds}
+
+def _try_lock(f):
+    """以非阻塞方式给打开的锁文件加排他锁，已被其他会话持有时返回 False"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+def _remove_scratch(scratch_dir, lock_file):
+    # 先释放锁再删除目录（Windows 上不能删除打开的文件）
+    lock_file.close()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class SpilledImage(EncodedImage):
+    """已经写到临时目录的图片，数据在用到时才从磁盘读取，raw 格式用内存映射读取
+
+    对象被释放（从会话中删除或被替换）时删除对应的文件。
+    """
+
+    __slots__ = ('path', 'file_size', '__weakref__')
+
+    spilled = True
+
+    def __init__(self, path, format, size, mode, digest=None):
+        self.path = path
+        self.format = format
+        self.size = size
+        self.mode = mode
+        self._digest = digest
+        self.file_size = os.path.getsize(path)
+        weakref.finalize(self, _remove_file, path)
+
+    @property
+    def data(self):
+        if self.format == 'raw':
+            return np.memmap(self.path, dtype=np.uint8, mode='r')
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def nbytes(self):
+        return self.file_size
+
+    def open(self):
+        if self.format == 'raw':
+            return Image.frombuffer(self.mode, self.size, self.data, 'raw', self.mode, 0, 1).copy()
+        return super().open()
+
+class SpilledBytes(EncodedBytes):
+    """已经写到临时目录的非图片数据，用到时才从磁盘读取；对象被释放时删除对应的文件"""
+
+    __slots__ = ('path', 'file_size', '__weakref__')
+
+    spilled = True
+
+    def __init__(self, path, format, digest=None):
+        self.path = path
+        self.format = format
+        self._digest = digest
+        self.file_size = os.path.getsize(path)
+        weakref.finalize(self, _remove_file, path)
+
+    @property
+    def data(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    @property
+    def nbytes(self):
+        return self.file_size
+
+class SessionStore:
+    """一个会话中所有中间图片共用的内存预算
+
+    mapping(namespace) 返回的字典在常驻字节数超过预算时，把整个会话中最久未使用的图片写到会话的临时目录，
+    替换为 SpilledImage（非图片数据为 SpilledBytes）；读取溢出的图片时直接从磁盘解码，不再放回内存。临时目录在第一次溢出时创建，
+    close() 或会话对象被释放（以及进程退出）时删除。
+    """
+
+    def __init__(self, budget_bytes=None, scratch_root=SCRATCH_DIR):
+        self.budget_bytes = int(MEMORY_BUDGET_MB * 1024 * 1024) if budget_bytes is None else budget_bytes
+        self.scratch_root = scratch_root
+        self.scratch_dir = None
+        self.maps = {}
+        self.resident = OrderedDict()  # (namespace, key) -> 字节数，按最近使用排序
+        self.resident_bytes = 0
+        self.spill_count = 0
+        self.lock = threading.RLock()
+        self._finalizer = None
+
+    def mapping(self, namespace):
+        """返回命名空间对应的字典（{名称: EncodedImage}），同一命名空间总是返回同一个对象"""
+        with self.lock:
+            if namespace not in self.maps:
+                self.maps[namespace] = SpillingDict(self, namespace)
+            return self.maps[namespace]
+
+    def _scratch(self):
+        if self.scratch_dir is None:
+            os.makedirs(self.scratch_root, exist_ok=True)
+            cleanup_stale_scratch(self.scratch_root)
+            self.scratch_dir = tempfile.mkdtemp(prefix='session_', dir=self.scratch_root)
+            # 加锁后才写入进程号，清理时空的锁文件表示目录还在创建中
+            lock_file = open(os.path.join(self.scratch_dir, SCRATCH_LOCK_NAME), 'wb')
+            _try_lock(lock_file)
+            lock_file.write(str(os.getpid()).encode('ascii'))
+            lock_file.flush()
+            self._finalizer = weakref.finalize(self, _remove_scratch, self.scratch_dir, lock_file)
+        return self.scratch_dir
+
+    def _add(self, namespace, key, nbytes):
+        with self.lock:
+            self.resident[(namespace, key)] = nbytes
+            self.resident_bytes += nbytes
+            self._enforce()
+
+    def _discard(self, namespace, key):
+        with self.lock:
+            nbytes = self.resident.pop((namespace, key), None)
+            if nbytes is not None:
+                self.resident_bytes -= nbytes
+
+    def _touch(self, namespace, key):
+        with self.lock:
+            if (namespace, key) in self.resident:
+                self.resident.move_to_end((namespace, key))
+
+    def _enforce(self):
+        """把最久未使用的图片写到临时目录，直到常驻字节数不超过预算"""
+        if self.budget_bytes <= 0:
+            return
+        while self.resident_bytes > self.budget_bytes and self.resident:
+            (namespace, key), nbytes = self.resident.popitem(last=False)
+            self.resident_bytes -= nbytes
+            image = self.maps[namespace].data[key]
+            self.spill_count += 1
+            path = os.path.join(self._scratch(), f"{self.spill_count}.{image.format}")
+            with open(path, 'wb') as f:
+                f.write(image.data)
+            self.maps[namespace].data[key] = image.spill(path)
+
+    def stats(self):
+        """常驻和溢出到磁盘的字节数及图片数"""
+        with self.lock:
+            spilled = [value for store in self.maps.values() for value in store.data.values() if value.spilled]
+            return {'budget_bytes': self.budget_bytes, 'resident_bytes': self.resident_bytes, 'resident': len(self.resident),
+                    'spilled_bytes': sum(value.file_size for value in spilled), 'spilled': len(spilled)}
+
+    def close(self):
+        """清空所有图片并删除临时目录"""
+        with self.lock:
+            for store in self.maps.values():
+                store.data.clear()
+            self.resident.clear()
+            self.resident_bytes = 0
+            if self._finalizer is not None:
+                self._finalizer()
+                self._finalizer = None
+                self.scratch_dir = None
+
+class SpillingDict(MutableMapping):
+    """SessionStore 中一个命名空间的图片，用法与 {名称: EncodedImage 或 EncodedBytes} 字典相同"""
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+        self.data = {}
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        self.store._touch(self.namespace, key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.store.lock:
+            if key in self.data:
+                del self[key]
+            self.data[key] = value
+            if not value.spilled:
+                self.store._add(self.namespace, key, value.nbytes)
+
+    def __delitem__(self, key):
+        with self.store.lock:
+            del self.data[key]
+            self.store._discard(self.namespace, key)
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+class DecodedImages(Mapping):
+    """按需解码的只读视图 {名称: PIL 图像}，渲染和导出时不必同时解码所有图片"""
+
+    def __init__(self, store, codec):
+        self.store = store
+        self.codec = codec
+
+    def __getitem__(self, key):
+        return self.codec.decode(self.store[key])
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+def _owner_dead(lock_path):
+    """锁文件可以加锁时，持有它的会话已经关闭或所在进程已经退出"""
+    with open(lock_path, 'rb') as f:
+        return _try_lock(f)
+
+def cleanup_stale_scratch(scratch_root=SCRATCH_DIR, max_age=SCRATCH_MAX_AGE):
+    """删除所属会话已经不存在的目录（进程崩溃时没有机会清理）
+
+    仍在使用的会话一直持有目录中的锁文件，无论空闲多久都不会被删除；没有锁文件（旧版本创建）
+    或锁文件为空（正在创建，或在写入进程号之前崩溃）的目录按修改时间判断。
+    """
+    now = time.time()
+    for name in os.listdir(scratch_root):
+        path = os.path.join(scratch_root, name)
+        if not name.startswith('session_'):
+            continue
+        try:
+            lock_path = os.path.join(path, SCRATCH_LOCK_NAME)
+            if os.path.exists(lock_path) and os.path.getsize(lock_path) > 0:
+                stale = _owner_dead(lock_path)
+            else:
+                stale = now - os.path.getmtime(path) > max_age
+        except OSError:
+            continue
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
@@ -1,6 +1,13 @@
+import io
 import os
 import math
+import functools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
+from packing import create_packer
+import metrics
 
 # A4纸的尺寸（像素，300dpi）
 A4_WIDTH = 2480
@@ -17,6 +24,16 @@ FONT_COLOR = (0, 0, 0)  # 黑色
 # 使用默认字体
 FONT_PATH = None  # 使用默认字体
 
+# 默认排版引擎，可选值见 packing.PACKERS（'grid' 为原来的网格扫描）
+DEFAULT_PACKING_ENGINE = 'maxrects'
+
+# 排列方式：'single' 为原来的逐页排列，'first_fit' / 'best_fit' 同时保持所有页面打开以回填空隙
+LAYOUT_MODES = ('single', 'first_fit', 'best_fit')
+DEFAULT_LAYOUT_MODE = 'first_fit'
+
+# 排版结果缓存的最大条目数（LRU 淘汰）
+LAYOUT_CACHE_SIZE = 32
+
 def get_image_sizes(folder_path):
     image_sizes = []
     for filename in os.listdir(folder_path):
@@ -25,82 +42,384 @@ def get_image_sizes(folder_path):
                 image_sizes.append((filename, img.size))
     return image_sizes
 
+def new_page(engine=DEFAULT_PACKING_ENGINE, allow_rotation=False):
+    """创建一个空白 A4 页面的排版引擎"""
+    return create_packer(engine, A4_WIDTH, A4_HEIGHT, MIN_MARGIN, MIN_SPACING, allow_rotation)
+
 def can_place_image(page, x, y, width, height):
-    for _, (w, h), (px, py) in page:
-        if (x < px + w + MIN_SPACING and x + width + MIN_SPACING > px and
-            y < py + h + MIN_SPACING and y + height + MIN_SPACING > py):
-            return False
-    return True
+    packer = new_page('grid')
+    packer.placements = page
+    return packer.can_place(x, y, width, height)
 
 def find_position(page, image_size):
-    width, height = image_size
-    best_position = None
-    min_waste = float('inf')
+    packer = new_page('grid')
+    packer.placements = page
+    placement = packer.find_position(image_size)
+    return placement[0] if placement else None
 
-    for y in range(MIN_MARGIN, A4_HEIGHT - height - MIN_MARGIN + 1, MIN_SPACING):
-        for x in range(MIN_MARGIN, A4_WIDTH - width - MIN_MARGIN + 1, MIN_SPACING):
-            if can_place_image(page, x, y, width, height):
-                waste = x + y  # 优先选择靠近左上角的位置
-                if waste < min_waste:
-                    min_waste = waste
-                    best_position = (x, y)
+def place_on_new_page(filename, size, engine, allow_rotation):
+    """在新页面上放置图片，返回该页的排版引擎；图片超过页面时返回只含这张图片的页面列表"""
+    page = new_page(engine, allow_rotation)
+    placement = page.find_position(size)
+    if placement:
+        position, placed_size = placement
+        page.place(filename, placed_size, position)
+        return page
+    print(f"警告：图片 {filename} 太大，将单独放置在一个页面上。")
+    return [(filename, size, (MIN_MARGIN, MIN_MARGIN))]
 
-    return best_position
+@metrics.timed('layout')
+def layout_images(image_sizes, engine=DEFAULT_PACKING_ENGINE, allow_rotation=False, mode=DEFAULT_LAYOUT_MODE):
+    """排列图片
+
+    engine 为 packing.PACKERS 中的排版引擎；allow_rotation 允许图片旋转 90° 放置；
+    mode 为 'single'（只保留当前页，放不下就换页）、'first_fit'（放到第一个放得下的已打开页面）
+    或 'best_fit'（放到放下后剩余面积最小的已打开页面）。
+    """
+    if mode not in LAYOUT_MODES:
+        raise ValueError(f"Unknown layout mode: {mode}. Available: {', '.join(LAYOUT_MODES)}")
 
-def layout_images(image_sizes):
-    pages = []
-    current_page = []
-    
     # 按面积从大到小排序图片
     image_sizes.sort(key=lambda x: x[1][0] * x[1][1], reverse=True)
+
+    if mode == 'single':
+        return layout_single_page(image_sizes, engine, allow_rotation)
+    return layout_open_pages(image_sizes, engine, allow_rotation, best_fit=(mode == 'best_fit'))
+
+def layout_single_page(image_sizes, engine, allow_rotation):
+    """原来的排列方式：只保留当前页，放不下就关闭当前页并新开一页"""
+    pages = []
+    current_page = new_page(engine, allow_rotation)
     
     for filename, size in image_sizes:
-        position = find_position(current_page, size)
-        if position:
-            current_page.append((filename, size, position))
+        placement = current_page.find_position(size)
+        if placement:
+            position, placed_size = placement
+            current_page.place(filename, placed_size, position)
         else:
-            if current_page:
-                pages.append(current_page)
-                current_page = []
-            position = find_position(current_page, size)
-            if position:
-                current_page.append((filename, size, position))
+            if current_page.placements:
+                pages.append(current_page.placements)
+                current_page = new_page(engine, allow_rotation)
+            placement = current_page.find_position(size)
+            if placement:
+                position, placed_size = placement
+                current_page.place(filename, placed_size, position)
             else:
                 print(f"警告：图片 {filename} 太大，将单独放置在一个页面上。")
                 pages.append([(filename, size, (MIN_MARGIN, MIN_MARGIN))])
 
-    if current_page:
-        pages.append(current_page)
+    if current_page.placements:
+        pages.append(current_page.placements)
 
     return pages
 
-def add_filename_to_image(draw, filename, position):
-    font = ImageFont.load_default().font_variant(size=FONT_SIZE)
-    filename_without_ext = filename.rsplit('.', 1)[0]
-    left, top, right, bottom = draw.textbbox((0, 0), filename_without_ext, font=font)
-    text_width = right - left
+def layout_open_pages(image_sizes, engine, allow_rotation, best_fit=False):
+    """所有页面保持打开，后面的小图片可以回填前面页面的空隙（first-fit / best-fit decreasing）"""
+    pages = []  # 排版引擎，或超大图片单独占用的页面列表
+    open_pages = []
+    used_area = {}
+    # 面积上限只是必要条件（不含间距），用来在逐位置搜索之前跳过肯定放不下的页面
+    printable_area = (A4_WIDTH - 2 * MIN_MARGIN) * (A4_HEIGHT - 2 * MIN_MARGIN)
+    smallest_area = min((w * h for _, (w, h) in image_sizes), default=0)
+
+    for filename, size in image_sizes:
+        area = size[0] * size[1]
+        chosen = None
+        chosen_placement = None
+        for page in open_pages:
+            if used_area[id(page)] + area > printable_area:
+                continue
+            placement = page.find_position(size)
+            if placement is None:
+                continue
+            if not best_fit:
+                chosen, chosen_placement = page, placement
+                break
+            # best-fit：选择已用面积最大（放下后剩余面积最小）的页面
+            if chosen is None or used_area[id(page)] > used_area[id(chosen)]:
+                chosen, chosen_placement = page, placement
+
+        if chosen is not None:
+            position, placed_size = chosen_placement
+            chosen.place(filename, placed_size, position)
+            used_area[id(chosen)] += area
+            # 剩余面积连最小的图片都放不下时关闭该页，后面的图片不再搜索它
+            if used_area[id(chosen)] + smallest_area > printable_area:
+                open_pages.remove(chosen)
+            continue
+
+        page = place_on_new_page(filename, size, engine, allow_rotation)
+        pages.append(page)
+        if not isinstance(page, list):
+            open_pages.append(page)
+            used_area[id(page)] = area
+
+    return [page if isinstance(page, list) else page.placements for page in pages]
+
+def layout_stats(pages):
+    """返回每页的图片数量和填充率（图片面积 / 页边距内的可用面积）"""
+    printable_area = (A4_WIDTH - 2 * MIN_MARGIN) * (A4_HEIGHT - 2 * MIN_MARGIN)
+    stats = []
+    for i, page in enumerate(pages):
+        image_area = sum(w * h for _, (w, h), _ in page)
+        stats.append({'page': i + 1, 'images': len(page), 'fill_ratio': image_area / printable_area})
+    return stats
+
+def print_layout_stats(pages):
+    """打印页数和每页填充率"""
+    stats = layout_stats(pages)
+    print(f"Total pages: {len(stats)}")
+    for page_stats in stats:
+        print(f"  Page {page_stats['page']}: {page_stats['images']} images, fill {page_stats['fill_ratio']:.1%}")
+    if stats:
+        average = sum(page_stats['fill_ratio'] for page_stats in stats) / len(stats)
+        print(f"  Average fill: {average:.1%}")
+
+class LayoutCache:
+    """排版结果缓存
+
+    键为排序后的图片尺寸列表加上页面常量和排版参数，与文件名无关；缓存的排版中每个位置
+    只记录它对应的尺寸序号，命中时把当前的文件名按尺寸重新分配上去，因此重命名或重复排列
+    同一批图片会直接返回，只有尺寸真正变化时才重新排版。
+    """
+
+    def __init__(self, max_size=LAYOUT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(sizes, engine, allow_rotation, mode):
+        return (sizes, A4_WIDTH, A4_HEIGHT, MIN_MARGIN, MIN_SPACING, engine, allow_rotation, mode)
+
+    def layout(self, image_sizes, engine=DEFAULT_PACKING_ENGINE, allow_rotation=False, mode=DEFAULT_LAYOUT_MODE):
+        # 按尺寸排序得到规范顺序，同尺寸的图片保持传入顺序
+        ordered = sorted(image_sizes, key=lambda item: tuple(item[1]))
+        sizes = tuple(tuple(size) for _, size in ordered)
+        key = self.make_key(sizes, engine, allow_rotation, mode)
+
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        if cached is None:
+            # 用尺寸序号代替文件名排版，结果与文件名无关
+            pages = layout_images([(index, size) for index, size in enumerate(sizes)], engine, allow_rotation, mode)
+            cached = tuple(tuple((index, tuple(size), tuple(position)) for index, size, position in page)
+                           for page in pages)
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = cached
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+        filenames = [filename for filename, _ in ordered]
+        return [[(filenames[index], size, position) for index, size, position in page] for page in cached]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'max_size': self.max_size}
+
+# 进程内共享的排版缓存，Streamlit 的所有会话共用
+layout_cache = LayoutCache()
+
+def layout_images_cached(image_sizes, engine=DEFAULT_PACKING_ENGINE, allow_rotation=False, mode=DEFAULT_LAYOUT_MODE):
+    """带缓存的 layout_images，返回格式相同"""
+    return layout_cache.layout(image_sizes, engine, allow_rotation, mode)
+
+@functools.lru_cache(maxsize=None)
+def get_font(size=FONT_SIZE):
+    """每个进程只加载一次字体"""
+    return ImageFont.load_default().font_variant(size=size)
+
+@functools.lru_cache(maxsize=4096)
+def measure_text(text, mode='RGB'):
+    """缓存文字的边界框，重复的文件名不再重新测量"""
+    return ImageDraw.Draw(Image.new(mode, (1, 1))).textbbox((0, 0), text, font=get_font())
+
+def add_filename_to_image(draw, filename, position, label=None):
+    """在图片左上方写出标签，默认为去掉扩展名的文件名"""
+    font = get_font()
+    filename_without_ext = filename.rsplit('.', 1)[0] if label is None else label
+    left, top, right, bottom = measure_text(filename_without_ext, draw.mode)
     text_height = bottom - top
     x, y = position
     draw.text((x+20, y - text_height +50), filename_without_ext, font=font, fill=FONT_COLOR)
 
-def create_pages(pages, resized_images):
-    result_pages = []
-    for i, page in enumerate(pages):
-        canvas = Image.new('RGB', (A4_WIDTH, A4_HEIGHT), 'white')
-        draw = ImageDraw.Draw(canvas)
-        for filename, size, position in page:
-            img = resized_images[filename]
-            canvas.paste(img, position)
-            add_filename_to_image(draw, filename, position)
-        result_pages.append(canvas)
-    return result_pages
+def load_resized_image(resized_images, filename):
+    """从字典或文件夹中取出一张缩放后的图片；文件夹中的图片在用到时才读取"""
+    if isinstance(resized_images, (str, os.PathLike)):
+        img = Image.open(os.path.join(resized_images, filename))
+        img.load()
+        return img
+    return resized_images[filename]
+
+@metrics.timed('render_page')
+def render_page(page, resized_images, labels=None):
+    """渲染一页 A4 画布；labels 为 {文件名: 标签文字}，没有列出的图片使用去掉扩展名的文件名"""
+    canvas = Image.new('RGB', (A4_WIDTH, A4_HEIGHT), 'white')
+    draw = ImageDraw.Draw(canvas)
+    for filename, size, position in page:
+        img = load_resized_image(resized_images, filename)
+        if img.size != tuple(size):
+            # 排版时旋转了 90° 的图片
+            img = img.transpose(Image.Transpose.ROTATE_90)
+        canvas.paste(img, position)
+        add_filename_to_image(draw, filename, position, labels.get(filename) if labels else None)
+    return canvas
+
+def iter_pages(pages, resized_images):
+    """逐页生成 A4 画布，调用方处理完一页再生成下一页，内存中只保留一页"""
+    for page in pages:
+        yield render_page(page, resized_images)
+
+def folder_sink(output_folder, format='PNG'):
+    """返回把页面依次写入文件夹的输出函数"""
+    os.makedirs(output_folder, exist_ok=True)
+
+    def write(index, canvas):
+        path = os.path.join(output_folder, f"page_{index + 1}.{format.lower()}")
+        canvas.save(path, format=format)
+        return path
+
+    return write
+
+def save_pages(pages, resized_images, sink):
+    """流式渲染并输出每一页，输出后立即释放画布，峰值内存与页数无关
+
+    sink 为输出文件夹路径，或 sink(index, canvas) 形式的函数；返回每页 sink 的返回值列表。
+    """
+    if isinstance(sink, (str, os.PathLike)):
+        sink = folder_sink(sink)
+    results = []
+    for index, canvas in enumerate(iter_pages(pages, resized_images)):
+        results.append(sink(index, canvas))
+        canvas.close()
+    return results
+
+@metrics.timed('create_pages')
+def create_pages(pages, resized_images, output_folder=None):
+    """渲染所有页面
+
+    resized_images 为 {文件名: 图片} 字典或缩放后图片所在的文件夹；指定 output_folder 时逐页写入
+    文件夹并返回文件路径，否则返回所有画布的列表。
+    """
+    if output_folder is not None:
+        return save_pages(pages, resized_images, output_folder)
+    return list(iter_pages(pages, resized_images))
+
+@metrics.timed('encode_page')
+def encode_page(canvas, format='PNG'):
+    """把一页画布编码为图片字节，串行和并行渲染使用同一个编码函数"""
+    buffer = io.BytesIO()
+    canvas.save(buffer, format=format)
+    return buffer.getvalue()
+
+def _render_encoded_page(page, resized_images, format):
+    """进程池中执行：渲染一页并编码，画布不跨进程传递"""
+    canvas = render_page(page, resized_images)
+    try:
+        return encode_page(canvas, format)
+    finally:
+        canvas.close()
+
+def _render_encoded_page_with_metrics(page, resized_images, format, memory):
+    """在子进程中开启统计渲染一页，返回 (编码后的字节, 本页的阶段统计)，由主进程合并"""
+    metrics.enable(memory)
+    metrics.use(metrics.recorder)  # fork 出的子进程可能带着某个会话的 Recorder，统一记到全局的 Recorder
+    metrics.recorder.drain()  # fork 出的子进程会带着主进程的统计，先丢弃
+    data = _render_encoded_page(page, resized_images, format)
+    return data, metrics.recorder.drain()
+
+def _page_images(page, resized_images):
+    """只把本页用到的图片传给工作进程；文件夹路径原样传递，由工作进程自己读取"""
+    if isinstance(resized_images, (str, os.PathLike)):
+        return resized_images
+    return {filename: resized_images[filename] for filename, _, _ in page}
+
+def render_pages_parallel(pages, resized_images, max_workers=None, format='PNG'):
+    """在多个进程中并行渲染并编码页面，按页码顺序逐页产出编码后的字节
+
+    每个工作进程在启动时加载一次字体；结果与串行的 encode_page(render_page(...)) 逐字节相同。
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, max(1, len(pages)))
+    if max_workers == 1:
+        for page in pages:
+            yield _render_encoded_page(page, resized_images, format)
+        return
+
+    # 同时在途的页面数有上限，已编码的页面按顺序产出后即释放
+    window = max_workers * 2
+    pending = deque()
+    next_page = 0
+    session_recorder = metrics.active_recorder()
+    collect_metrics = session_recorder is not None
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=get_font) as executor:
+        try:
+            while next_page < len(pages) or pending:
+                while next_page < len(pages) and len(pending) < window:
+                    page = pages[next_page]
+                    if collect_metrics:
+                        pending.append(executor.submit(_render_encoded_page_with_metrics, page, _page_images(page, resized_images),
+                                                       format, metrics.memory_enabled()))
+                    else:
+                        pending.append(executor.submit(_render_encoded_page, page, _page_images(page, resized_images), format))
+                    next_page += 1
+                data = pending.popleft().result()
+                if collect_metrics:
+                    data, stages = data
+                    session_recorder.merge(stages)
+                yield data
+        finally:
+            # 调用方提前停止迭代时取消尚未开始的页面，不必等它们渲染完
+            for future in pending:
+                future.cancel()
+
+def arrange_folder(resize_folder, output_folder, engine=DEFAULT_PACKING_ENGINE, mode=DEFAULT_LAYOUT_MODE, max_workers=None,
+                   progress_callback=None, stop_check=None):
+    """排列文件夹中缩放后的图片，并行渲染，每完成一页就写入 output_folder，返回已写入的文件路径
+
+    progress_callback(value, current, total) 和 stop_check() 与 detectAndCorrectReceipts 的约定相同，
+    stop_check() 在每页之间检查。
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    pages = layout_images(get_image_sizes(resize_folder), engine, mode=mode)
+    total = len(pages)
+    paths = []
+    for index, data in enumerate(render_pages_parallel(pages, resize_folder, max_workers)):
+        if stop_check is not None and stop_check():
+            break
+        path = os.path.join(output_folder, f"page_{index + 1}.png")
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+        if progress_callback is not None:
+            progress_callback(int((index + 1) / total * 100), index + 1, total)
+    print_layout_stats(pages)
+    return paths
 
-def main(resized_images):
+def main(resized_images, sink=None):
+    """排版并渲染；指定 sink 时逐页输出并返回 sink 的返回值列表，否则返回所有画布"""
     image_sizes = [(name, img.size) for name, img in resized_images.items()]
-    pages = layout_images(image_sizes)
-    result_pages = create_pages(pages, resized_images)
+    pages = layout_images_cached(image_sizes)
+    if sink is not None:
+        result_pages = save_pages(pages, resized_images, sink)
+    else:
+        result_pages = create_pages(pages, resized_images)
     
     print(f"Total images processed: {len(image_sizes)}")
     print(f"Total pages created: {len(result_pages)}")
+    print_layout_stats(pages)
     
     return result_pages
@@ -1,47 +1,25 @@
 import sys
 import os
 from PyQt5.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, 
-                             QLabel, QLineEdit, QMessageBox, QProgressBar, QSpacerItem, QSizePolicy, QFrame)
+                             QLabel, QLineEdit, QMessageBox, QProgressBar, QSpacerItem, QSizePolicy, QFrame, QCheckBox)
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QObject
 from PyQt5.QtGui import QPixmap, QFont
-from PIL import Image
-import cv2
-import numpy as np
 
 # 导入之前的函数
-from process_receipt import detectAndCorrectReceipt
-from resize import resize_image
-from layout_images import layout_images, create_pages
-
-class WorkerThread(QThread):
-    progress = pyqtSignal(int)
-    finished = pyqtSignal()
-
-    def __init__(self, function, *args, **kwargs):
-        super().__init__()
-        self.function = function
-        self.args = args
-        self.kwargs = kwargs
-        self.is_running = True
-
-    def run(self):
-        self.is_running = True
-        self.function(*self.args, **self.kwargs, progress_callback=self.progress.emit, stop_check=self.stop_check)
-        self.finished.emit()
-
-    def stop_check(self):
-        return not self.is_running
-
-    def quit(self):
-        self.is_running = False
-        super().quit()
+from process_receipt import extractReceiptsFromFolder
+from resize import process_images
+from layout_images import arrange_folder
+import metrics
 
 class ReceiptProcessorApp(QWidget):
     def __init__(self):
         super().__init__()
         self.threads = []
+        self.worker = None
         self.input_folder = ''
         self.progress_label = QLabel('', self)
+        self.resize_label = QLabel('', self)
+        self.arrange_label = QLabel('', self)
         self.initUI()
 
     def initUI(self):
@@ -84,6 +62,9 @@ class ReceiptProcessorApp(QWidget):
         self.resize_button = step3_layout.itemAt(2).widget()
         self.resize_button.clicked.connect(self.resize_images)
         step3_layout.addLayout(resize_input_layout)
+        self.resize_progress = QProgressBar(self)
+        step3_layout.addWidget(self.resize_progress)
+        step3_layout.addWidget(self.resize_label)
         main_layout.addLayout(step3_layout)
 
         main_layout.addWidget(self.create_separator())
@@ -94,8 +75,25 @@ class ReceiptProcessorApp(QWidget):
         self.start_button.clicked.connect(self.start_processing)
         self.arrange_progress = QProgressBar(self)
         step4_layout.addWidget(self.arrange_progress)
+        step4_layout.addWidget(self.arrange_label)
         main_layout.addLayout(step4_layout)
 
+        # 取消当前步骤：已完成的图片或页面保留，尚未开始的不再处理
+        self.cancel_button = QPushButton('Cancel', self)
+        self.cancel_button.setFixedWidth(120)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_job)
+        main_layout.addWidget(self.cancel_button)
+
+        # 各阶段的耗时统计，开启后每一步完成时把报告保存到所选文件夹
+        self.metrics_checkbox = QCheckBox('Save stage metrics (metrics.json / metrics.prom)', self)
+        self.metrics_checkbox.setChecked(metrics.is_enabled())
+        self.metrics_checkbox.toggled.connect(self.toggle_metrics)
+        main_layout.addWidget(self.metrics_checkbox)
+        self.metrics_label = QLabel('', self)
+        self.metrics_label.setFont(QFont('Courier New', 9))
+        main_layout.addWidget(self.metrics_label)
+
         main_layout.addStretch(1)
 
         # 添加logo、开发者信息和版本号
@@ -156,6 +154,22 @@ class ReceiptProcessorApp(QWidget):
                 if isinstance(item, QPushButton):
                     item.setEnabled(True)
 
+    def toggle_metrics(self, checked):
+        if checked:
+            metrics.enable()
+        else:
+            metrics.disable()
+
+    def save_metrics(self):
+        """开启统计时把本批次的报告保存到所选文件夹，并在界面上显示"""
+        if not metrics.is_enabled() or not self.input_folder:
+            return
+        report = metrics.report()
+        metrics.save_report(os.path.join(self.input_folder, 'metrics.json'), report)
+        metrics.save_report(os.path.join(self.input_folder, 'metrics.prom'), report)
+        self.metrics_label.setText(metrics.format_report(report))
+        print(metrics.format_report(report))
+
     def add_images(self):
         self.disable_all_except(self.add_button)
         self.input_folder = QFileDialog.getExistingDirectory(self, "Select Folder...")
@@ -165,50 +179,59 @@ class ReceiptProcessorApp(QWidget):
             self.image_count_label.setText(f'{image_count} images found')
         self.enable_all()
 
+    def start_job(self, button, progress_bar, label, done_message, function, *args, **kwargs):
+        """在后台线程中执行一个步骤；function 接受 progress_callback 和 stop_check，
+        各步骤内部用进程池或线程池并行处理，每完成一项就写入结果"""
+        self.disable_all_except(button)
+        progress_bar.setValue(0)
+        label.setText('')
+
+        thread = QThread()
+        self.threads.append(thread)
+        worker = Worker(function, *args, **kwargs)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.progress.connect(lambda value, current, total: self.update_progress(progress_bar, label, value, current, total))
+        worker.finished.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.finished.connect(lambda: self.threads.remove(thread))
+        worker.finished.connect(lambda: self.on_job_finished(worker, done_message))
+        self.worker = worker
+        self.cancel_button.setEnabled(True)
+        thread.start()
+
+    def update_progress(self, progress_bar, label, value, current, total):
+        progress_bar.setValue(value)
+        label.setText(f'({current}/{total})')
+
+    def cancel_job(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.cancel_button.setEnabled(False)
+
+    def on_job_finished(self, worker, done_message):
+        self.worker = None
+        self.cancel_button.setEnabled(False)
+        self.enable_all()
+        self.save_metrics()
+        if worker.error:
+            QMessageBox.critical(self, "Error", f"Error occurred while processing images: {worker.error}")
+        elif not worker.is_running:
+            QMessageBox.information(self, "Cancelled", "Cancelled. Results finished so far have been saved.")
+        else:
+            QMessageBox.information(self, "Completed", done_message)
+
     def extract_receipts(self):
         if not self.input_folder:
             QMessageBox.warning(self, "Warning", "Please select a folder first!")
             return
 
         receipts_folder = os.path.join(self.input_folder, 'receipts')
-        if not os.path.exists(receipts_folder):
-            os.makedirs(receipts_folder)
-
-        try:
-            self.disable_all_except(self.extract_button)
-            self.extract_progress.setValue(0)
-
-            # 创建一个 QThread 对象
-            self.thread = QThread()
-            self.threads.append(self.thread)  # Add to thread list
-            # 创建一个 worker 对象
-            self.worker = Worker(detectAndCorrectReceipt, self.input_folder)
-            # 将 worker 移动到线程
-            self.worker.moveToThread(self.thread)
-            # 连接信号和槽
-            self.thread.started.connect(self.worker.run)
-            self.worker.finished.connect(self.thread.quit)
-            self.worker.finished.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-            self.worker.progress.connect(self.update_extract_progress)
-            # 启动线程
-            self.thread.start()
-
-            # 最后，线程结束时恢复按钮状态并显示完成消息
-            self.thread.finished.connect(
-                lambda: self.enable_all()
-            )
-            self.thread.finished.connect(
-                lambda: QMessageBox.information(self, "Completed", "Receipts extracted and saved in receipts folder.")
-            )
-
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Error occurred while processing images: {str(e)}")
-            self.enable_all()
-
-    def update_extract_progress(self, value, current, total):
-        self.extract_progress.setValue(value)
-        self.progress_label.setText(f'({current}/{total})')
+        metrics.reset()  # 每次提取开始一个新的批次报告
+        self.start_job(self.extract_button, self.extract_progress, self.progress_label,
+                       "Receipts extracted and saved in receipts folder.",
+                       extractReceiptsFromFolder, self.input_folder, receipts_folder)
 
     def resize_images(self):
         if not self.input_folder:
@@ -224,16 +247,9 @@ class ReceiptProcessorApp(QWidget):
 
         receipts_folder = os.path.join(self.input_folder, 'receipts')
         resize_folder = os.path.join(self.input_folder, 'resize')
-        if not os.path.exists(resize_folder):
-            os.makedirs(resize_folder)
-
-        for filename in os.listdir(receipts_folder):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                input_path = os.path.join(receipts_folder, filename)
-                output_path = os.path.join(resize_folder, filename)
-                resize_image(input_path, output_path, scale_factor)
-
-        QMessageBox.information(self, "Completed", "Images resized and saved in resize folder.")
+        self.start_job(self.resize_button, self.resize_progress, self.resize_label,
+                       "Images resized and saved in resize folder.",
+                       process_images, receipts_folder, resize_folder, scale_factor, mode='fast')
 
     def start_processing(self):
         if not self.input_folder:
@@ -242,51 +258,18 @@ class ReceiptProcessorApp(QWidget):
 
         resize_folder = os.path.join(self.input_folder, 'resize')
         output_folder = os.path.join(self.input_folder, 'output')
-
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-
-        try:
-            self.disable_all_except(self.start_button)
-            self.worker = WorkerThread(self.process_images, resize_folder, output_folder)
-            self.threads.append(self.worker)  # Add to thread list
-            self.worker.progress.connect(self.update_arrange_progress)
-            self.worker.finished.connect(self.on_arrange_finished)
-            self.worker.start()
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Error occurred while processing images: {str(e)}")
-            self.enable_all()
-
-    def process_images(self, resize_folder, output_folder, progress_callback, stop_check):
-        try:
-            image_sizes = [(f, Image.open(os.path.join(resize_folder, f)).size) 
-                           for f in os.listdir(resize_folder) 
-                           if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-            
-            pages = layout_images(image_sizes)
-            total_pages = len(pages)
-            
-            create_pages(pages, resize_folder, output_folder)
-            
-            for i in range(total_pages):
-                if stop_check():
-                    break
-                progress_callback(int((i + 1) / total_pages * 100))
-            
-        except Exception as e:
-            print(f"Error occurred while processing images: {str(e)}")
-            raise
-
-    def update_arrange_progress(self, value):
-        self.arrange_progress.setValue(value)
-
-    def on_arrange_finished(self):
-        self.enable_all()
-        QMessageBox.information(self, "Completed", "Images arranged and saved in output folder.")
+        self.start_job(self.start_button, self.arrange_progress, self.arrange_label,
+                       "Images arranged and saved in output folder.",
+                       arrange_folder, resize_folder, output_folder)
 
     def closeEvent(self, event):
         # Stop all threads
-        for thread in self.threads:
+        if self.worker is not None:
+            try:
+                self.worker.stop()  # 取消尚未开始的任务
+            except RuntimeError:
+                pass  # worker 已经结束并被 deleteLater 释放
+        for thread in list(self.threads):
             thread.quit()
             thread.wait()
         super().closeEvent(event)
@@ -301,11 +284,25 @@ class Worker(QObject):
         self.function = function
         self.args = args
         self.kwargs = kwargs
+        self.is_running = True
+        self.error = None
 
     def run(self):
-        self.function(*self.args, **self.kwargs, progress_callback=self.progress.emit)
+        self.is_running = True
+        try:
+            self.function(*self.args, **self.kwargs, progress_callback=self.progress.emit, stop_check=self.stop_check)
+        except Exception as e:
+            # 出错时也要发出 finished，否则线程不会退出，按钮也不会恢复
+            print(f"Error occurred while processing images: {str(e)}")
+            self.error = str(e)
         self.finished.emit()
 
+    def stop_check(self):
+        return not self.is_running
+
+    def stop(self):
+        self.is_running = False
+
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     ex = ReceiptProcessorApp()
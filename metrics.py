@@ -0,0 +1,244 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# 各处理阶段的耗时和峰值内存统计。默认关闭，关闭时 span() 返回共享的空上下文，几乎没有开销；
+# 设置环境变量 RECEIPT_METRICS=1 或调用 enable() 开启，RECEIPT_METRICS=memory 时同时用 tracemalloc 记录峰值内存。
+# 多个用户共用一个进程时（Streamlit），每个会话用 use() 指定自己的 Recorder，不修改全局开关
+METRICS_MODE = os.environ.get('RECEIPT_METRICS', '')
+
+# Prometheus 文本格式中指标名称的前缀
+METRIC_PREFIX = 'receipt_stage'
+
+_NULL_SPAN = nullcontext()
+
+# 当前上下文使用的记录器；_UNSET 表示跟随全局开关，None 表示在当前上下文中关闭
+_UNSET = object()
+_active = contextvars.ContextVar('receipt_metrics_recorder', default=_UNSET)
+
+# tracemalloc 的峰值是整个进程共用的，reset_peak() 会打断其他线程中正在统计的阶段。
+# 同一时间只有一个线程（第一个进入阶段的线程，直到它的所有阶段结束）记录峰值内存，其他线程的阶段只计时；
+# 记录的峰值是整个进程在该阶段内的峰值，并发线程的分配也会计入
+_memory_lock = threading.Lock()
+_memory_owner = None
+_memory_depth = 0
+
+def _claim_memory():
+    global _memory_owner, _memory_depth
+    ident = threading.get_ident()
+    with _memory_lock:
+        if _memory_owner is None or _memory_owner == ident:
+            _memory_owner = ident
+            _memory_depth += 1
+            return True
+        return False
+
+def _release_memory():
+    global _memory_owner, _memory_depth
+    with _memory_lock:
+        _memory_depth -= 1
+        if _memory_depth == 0:
+            _memory_owner = None
+
+class Recorder:
+    """按阶段名称累计调用次数、总耗时、最大耗时和峰值内存"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.local = threading.local()
+        self.started = time.time()
+
+    def add(self, name, seconds, peak_bytes=0):
+        self.merge({name: {'count': 1, 'seconds': seconds, 'max_seconds': seconds, 'peak_bytes': peak_bytes}})
+
+    def merge(self, stages):
+        """累加统计，也用于合并另一个进程 drain() 返回的统计"""
+        with self.lock:
+            for name, other in stages.items():
+                stage = self.stages.get(name)
+                if stage is None:
+                    stage = self.stages[name] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': 0}
+                stage['count'] += other['count']
+                stage['seconds'] += other['seconds']
+                stage['max_seconds'] = max(stage['max_seconds'], other['max_seconds'])
+                stage['peak_bytes'] = max(stage['peak_bytes'], other['peak_bytes'])
+
+    def drain(self):
+        """取出并清空当前统计，用于把子进程中的统计传回主进程"""
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.started = time.time()
+
+    def report(self):
+        """本批次的统计报告（可以直接序列化为 JSON）"""
+        with self.lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            started = self.started
+        for stage in stages.values():
+            stage['mean_seconds'] = stage['seconds'] / stage['count'] if stage['count'] else 0.0
+        return {'started': started, 'finished': time.time(), 'stages': stages}
+
+class Span:
+    """一个阶段的计时上下文；开启内存统计时，嵌套的子阶段不会影响父阶段的峰值"""
+
+    __slots__ = ('recorder', 'name', 'start', 'base', 'child_peak', 'track_memory')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.child_peak = 0
+        self.track_memory = tracemalloc.is_tracing() and _claim_memory()
+        if self.track_memory:
+            stack = getattr(self.recorder.local, 'stack', None)
+            if stack is None:
+                stack = self.recorder.local.stack = []
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            stack.append(self)
+            tracemalloc.reset_peak()
+            self.base = current
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        peak_bytes = 0
+        if self.track_memory:
+            stack = self.recorder.local.stack
+            stack.pop()
+            if tracemalloc.is_tracing():
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self.child_peak)
+                peak_bytes = max(0, peak - self.base)
+                if stack:
+                    # reset_peak 丢掉了父阶段在进入本阶段之前的峰值，把本阶段的峰值交给父阶段
+                    stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            _release_memory()
+        self.recorder.add(self.name, seconds, peak_bytes)
+        return False
+
+recorder = Recorder()
+_enabled = bool(METRICS_MODE) and METRICS_MODE != '0'
+
+def enable(memory=None):
+    """开启统计；memory 为 True 时用 tracemalloc 记录峰值内存（有明显的额外开销）"""
+    global _enabled
+    _enabled = True
+    if memory is None:
+        memory = METRICS_MODE == 'memory'
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def use(session_recorder):
+    """在当前线程（上下文）中使用指定的 Recorder，None 表示关闭统计；返回用于 restore() 的令牌
+
+    Streamlit 的每次页面运行都在自己的线程中，会话各自调用 use() 不会互相影响，也不改变全局开关。
+    在线程池中运行的任务需要用 contextvars.copy_context().run 提交才能继承当前的设置。
+    """
+    return _active.set(session_recorder)
+
+def restore(token):
+    _active.reset(token)
+
+def active_recorder():
+    """当前上下文使用的 Recorder，关闭时返回 None"""
+    session_recorder = _active.get()
+    if session_recorder is not _UNSET:
+        return session_recorder
+    return recorder if _enabled else None
+
+def is_enabled():
+    return active_recorder() is not None
+
+def memory_enabled():
+    return tracemalloc.is_tracing()
+
+def span(name):
+    """统计一个阶段：with metrics.span('decode'): ...；关闭时返回空上下文"""
+    active = active_recorder()
+    if active is None:
+        return _NULL_SPAN
+    return Span(active, name)
+
+def timed(name):
+    """把整个函数作为一个阶段统计的装饰器，关闭时只多一次函数调用"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            active = active_recorder()
+            if active is None:
+                return function(*args, **kwargs)
+            with Span(active, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset():
+    (active_recorder() or recorder).reset()
+
+def report():
+    return (active_recorder() or recorder).report()
+
+def to_json(report_data=None):
+    return json.dumps(report_data or report(), indent=2)
+
+def to_prometheus(report_data=None):
+    """Prometheus 文本格式的报告"""
+    report_data = report_data or report()
+    metrics = [
+        ('calls_total', 'counter', 'Number of calls per stage', 'count'),
+        ('seconds_total', 'counter', 'Total seconds spent per stage', 'seconds'),
+        ('seconds_max', 'gauge', 'Slowest single call per stage in seconds', 'max_seconds'),
+        ('peak_bytes', 'gauge', 'Peak traced memory per stage in bytes', 'peak_bytes'),
+    ]
+    lines = []
+    for suffix, metric_type, help_text, field in metrics:
+        name = f"{METRIC_PREFIX}_{suffix}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for stage, values in sorted(report_data['stages'].items()):
+            lines.append(f'{name}{{stage="{stage}"}} {values[field]}')
+    return '\n'.join(lines) + '\n'
+
+def save_report(path, report_data=None):
+    """保存报告，扩展名为 .json 时写 JSON，否则写 Prometheus 文本；先写临时文件再替换"""
+    text = to_json(report_data) if path.lower().endswith('.json') else to_prometheus(report_data)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+def format_report(report_data=None):
+    """适合在界面上显示的多行文本"""
+    report_data = report_data or report()
+    lines = []
+    for stage, values in sorted(report_data['stages'].items(), key=lambda item: -item[1]['seconds']):
+        line = (f"{stage:<16} {values['count']:>5} calls  {values['seconds'] * 1000:>9.1f} ms total  "
+                f"{values['mean_seconds'] * 1000:>7.1f} ms mean")
+        if values['peak_bytes']:
+            line += f"  {values['peak_bytes'] / 1024 / 1024:>7.1f} MB peak"
+        lines.append(line)
+    return '\n'.join(lines)
+
+if _enabled:
+    enable()
@@ -0,0 +1,232 @@
+import logging
+import math
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 每个 packer 实例代表一页。约定：
+#   find_position(size) 返回 ((x, y), placed_size) 或 None，placed_size 在旋转 90° 时宽高互换
+#   place(filename, size, position) 记录一张已放置的图片
+#   placements 为该页的 (filename, size, position) 列表，与 create_pages 使用的页面格式一致
+
+class GridPacker:
+    """原始实现：按 spacing 步长扫描网格，选择最靠近左上角的位置"""
+
+    def __init__(self, width, height, margin, spacing, allow_rotation=False):
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self.spacing = spacing
+        self.allow_rotation = allow_rotation
+        self.placements = []
+
+    def can_place(self, x, y, width, height):
+        for _, (w, h), (px, py) in self.placements:
+            if (x < px + w + self.spacing and x + width + self.spacing > px and
+                y < py + h + self.spacing and y + height + self.spacing > py):
+                return False
+        return True
+
+    def _scan(self, size):
+        width, height = size
+        best_position = None
+        min_waste = float('inf')
+
+        for y in range(self.margin, self.height - height - self.margin + 1, self.spacing):
+            for x in range(self.margin, self.width - width - self.margin + 1, self.spacing):
+                if self.can_place(x, y, width, height):
+                    waste = x + y  # 优先选择靠近左上角的位置
+                    if waste < min_waste:
+                        min_waste = waste
+                        best_position = (x, y)
+
+        return best_position, min_waste
+
+    def find_position(self, size):
+        candidates = [size]
+        if self.allow_rotation and size[0] != size[1]:
+            candidates.append((size[1], size[0]))
+
+        best = None
+        best_waste = float('inf')
+        for candidate in candidates:
+            position, waste = self._scan(candidate)
+            if position is not None and waste < best_waste:
+                best = (position, candidate)
+                best_waste = waste
+        return best
+
+    def place(self, filename, size, position):
+        self.placements.append((filename, size, position))
+
+class MaxRectsPacker:
+    """MaxRects 装箱：维护页面上所有极大空闲矩形，按最短边最佳匹配（BSSF）选择位置
+
+    间距的处理方式是把每张图片向右、向下各扩展 spacing，页面可用区域同样向右下扩展 spacing，
+    这样扩展后的矩形互不重叠就等价于原图片之间至少相隔 spacing，与 GridPacker 的约束一致。
+    """
+
+    def __init__(self, width, height, margin, spacing, allow_rotation=False):
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self.spacing = spacing
+        self.allow_rotation = allow_rotation
+        self.placements = []
+        self.free_rects = [(margin, margin, width - 2 * margin + spacing, height - 2 * margin + spacing)]
+
+    def _score(self, free_rect, width, height):
+        """返回 (短边余量, 长边余量, y, x)，越小越好；放不下时返回 None"""
+        fx, fy, fw, fh = free_rect
+        if width > fw or height > fh:
+            return None
+        leftover_w = fw - width
+        leftover_h = fh - height
+        return (min(leftover_w, leftover_h), max(leftover_w, leftover_h), fy, fx)
+
+    def find_position(self, size):
+        candidates = [size]
+        if self.allow_rotation and size[0] != size[1]:
+            candidates.append((size[1], size[0]))
+
+        best = None
+        best_score = None
+        for candidate in candidates:
+            width = candidate[0] + self.spacing
+            height = candidate[1] + self.spacing
+            for free_rect in self.free_rects:
+                score = self._score(free_rect, width, height)
+                if score is not None and (best_score is None or score < best_score):
+                    best_score = score
+                    best = ((free_rect[0], free_rect[1]), candidate)
+        return best
+
+    def place(self, filename, size, position):
+        used = (position[0], position[1], size[0] + self.spacing, size[1] + self.spacing)
+        new_free = []
+        for free_rect in self.free_rects:
+            new_free.extend(self._split(free_rect, used))
+        self.free_rects = self._prune(new_free)
+        self.placements.append((filename, size, position))
+
+    @staticmethod
+    def _split(free_rect, used):
+        """从空闲矩形中切掉已占用区域，返回剩余的极大矩形"""
+        fx, fy, fw, fh = free_rect
+        ux, uy, uw, uh = used
+        if ux >= fx + fw or ux + uw <= fx or uy >= fy + fh or uy + uh <= fy:
+            return [free_rect]
+
+        result = []
+        if ux > fx:
+            result.append((fx, fy, ux - fx, fh))
+        if ux + uw < fx + fw:
+            result.append((ux + uw, fy, fx + fw - ux - uw, fh))
+        if uy > fy:
+            result.append((fx, fy, fw, uy - fy))
+        if uy + uh < fy + fh:
+            result.append((fx, uy + uh, fw, fy + fh - uy - uh))
+        return result
+
+    @staticmethod
+    def _prune(free_rects):
+        """去掉被其他空闲矩形完全包含的矩形"""
+        # 按面积从大到小排序后，只需检查每个矩形是否被之前保留的矩形包含
+        free_rects = sorted(set(free_rects), key=lambda r: r[2] * r[3], reverse=True)
+        kept = []
+        for rect in free_rects:
+            x, y, w, h = rect
+            contained = any(kx <= x and ky <= y and x + w <= kx + kw and y + h <= ky + kh
+                            for kx, ky, kw, kh in kept)
+            if not contained:
+                kept.append(rect)
+        return kept
+
+class BitmapPacker:
+    """与 GridPacker 结果完全一致的向量化实现
+
+    页面按 spacing 划分为粗网格，每张已放置的图片在占用位图上标记 ceil(w / spacing) + 1 列、
+    ceil(h / spacing) + 1 行的“足迹”（即向右下扩展 spacing 后覆盖的网格）。两张网格对齐的图片
+    满足间距约束当且仅当足迹不重叠，因此用积分图一次求出所有窗口和为 0 的左上角，
+    再选择 x + y 最小的位置（相同时取 y 较小者，与网格扫描顺序一致）。
+    """
+
+    def __init__(self, width, height, margin, spacing, allow_rotation=False):
+        self.width = width
+        self.height = height
+        self.margin = margin
+        self.spacing = spacing
+        self.allow_rotation = allow_rotation
+        self.placements = []
+        columns = (width - 2 * margin) // spacing + 3
+        rows = (height - 2 * margin) // spacing + 3
+        self.occupancy = np.zeros((rows, columns), dtype=np.int32)
+        self._integral = None
+
+    def _footprint(self, size):
+        return math.ceil(size[0] / self.spacing) + 1, math.ceil(size[1] / self.spacing) + 1
+
+    def _summed_area(self):
+        if self._integral is None:
+            integral = np.zeros((self.occupancy.shape[0] + 1, self.occupancy.shape[1] + 1), dtype=np.int32)
+            np.cumsum(np.cumsum(self.occupancy, axis=0, dtype=np.int32), axis=1, dtype=np.int32, out=integral[1:, 1:])
+            self._integral = integral
+        return self._integral
+
+    def _search(self, size):
+        """返回 (左上角网格坐标 (i, j), i + j)，没有可行位置时返回 (None, inf)"""
+        width, height = size
+        max_i = (self.width - width - 2 * self.margin) // self.spacing
+        max_j = (self.height - height - 2 * self.margin) // self.spacing
+        if max_i < 0 or max_j < 0:
+            return None, float('inf')
+
+        footprint_w, footprint_h = self._footprint(size)
+        integral = self._summed_area()
+        window = (integral[footprint_h:footprint_h + max_j + 1, footprint_w:footprint_w + max_i + 1]
+                  - integral[:max_j + 1, footprint_w:footprint_w + max_i + 1]
+                  - integral[footprint_h:footprint_h + max_j + 1, :max_i + 1]
+                  + integral[:max_j + 1, :max_i + 1])
+
+        js, is_ = np.nonzero(window == 0)
+        if js.size == 0:
+            return None, float('inf')
+        # nonzero 按行优先返回，argmin 在 i + j 相同时取 j 最小者
+        best = np.argmin(js + is_)
+        return (int(is_[best]), int(js[best])), int(is_[best] + js[best])
+
+    def find_position(self, size):
+        candidates = [size]
+        if self.allow_rotation and size[0] != size[1]:
+            candidates.append((size[1], size[0]))
+
+        best = None
+        best_cost = float('inf')
+        for candidate in candidates:
+            cell, cost = self._search(candidate)
+            if cell is not None and cost < best_cost:
+                position = (self.margin + cell[0] * self.spacing, self.margin + cell[1] * self.spacing)
+                best = (position, candidate)
+                best_cost = cost
+        return best
+
+    def place(self, filename, size, position):
+        i = (position[0] - self.margin) // self.spacing
+        j = (position[1] - self.margin) // self.spacing
+        footprint_w, footprint_h = self._footprint(size)
+        self.occupancy[max(0, j):j + footprint_h, max(0, i):i + footprint_w] = 1
+        self._integral = None
+        self.placements.append((filename, size, position))
+
+# 可用的排版引擎
+PACKERS = {
+    'grid': GridPacker,
+    'bitmap': BitmapPacker,
+    'maxrects': MaxRectsPacker,
+}
+
+def create_packer(engine, width, height, margin, spacing, allow_rotation=False):
+    """根据名称创建一页的排版引擎"""
+    if engine not in PACKERS:
+        raise ValueError(f"Unknown packing engine: {engine}. Available: {', '.join(PACKERS)}")
+    return PACKERS[engine](width, height, margin, spacing, allow_rotation)
@@ -0,0 +1,177 @@
+import io
+import os
+import zlib
+from PIL import Image, ImageDraw
+from layout_images import A4_WIDTH, FONT_SIZE, get_font, load_resized_image
+
+# A4 纸的尺寸（PDF 点，1 点 = 1/72 英寸）
+PAGE_WIDTH_PT = 595.28
+PAGE_HEIGHT_PT = 841.89
+
+# 排版使用的像素坐标（300dpi）到 PDF 点的换算比例
+PIXEL_TO_POINT = PAGE_WIDTH_PT / A4_WIDTH
+
+# 发票图片的压缩方式：'JPEG'（DCTDecode）或 'FLATE'（无损 FlateDecode）
+DEFAULT_IMAGE_FORMAT = 'JPEG'
+DEFAULT_JPEG_QUALITY = 85
+
+class PdfWriter:
+    """只支持本模块需要的对象类型的最小 PDF 写入器，对象写出后立即释放，可以流式写入"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.position = 0
+        self.offsets = {}
+        self.next_number = 1
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        """预留一个对象编号，稍后再写出对象内容"""
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def write_object(self, number, dictionary, stream=None):
+        self.offsets[number] = self.position
+        self._write(f"{number} 0 obj\n".encode('ascii'))
+        if stream is None:
+            self._write(dictionary.encode('latin-1'))
+        else:
+            self._write(dictionary[:-2].encode('latin-1') + f" /Length {len(stream)} >>".encode('ascii'))
+            self._write(b'\nstream\n')
+            self._write(stream)
+            self._write(b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def close(self, root_number):
+        xref_position = self.position
+        count = self.next_number
+        lines = [f"xref\n0 {count}\n", "0000000000 65535 f \n"]
+        for number in range(1, count):
+            lines.append(f"{self.offsets.get(number, 0):010d} 00000 n \n")
+        lines.append(f"trailer\n<< /Size {count} /Root {root_number} 0 R >>\nstartxref\n{xref_position}\n%%EOF\n")
+        self._write(''.join(lines).encode('ascii'))
+
+def escape_pdf_text(text):
+    """转义 PDF 字符串中的特殊字符"""
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def encode_image(img, image_format=DEFAULT_IMAGE_FORMAT, jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """把一张发票编码为 PDF 图片对象，返回 (字典, 数据)"""
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    color_space = '/DeviceGray' if img.mode == 'L' else '/DeviceRGB'
+
+    if image_format == 'JPEG':
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=jpeg_quality)
+        data = buffer.getvalue()
+        pdf_filter = '/DCTDecode'
+    elif image_format == 'FLATE':
+        data = zlib.compress(img.tobytes())
+        pdf_filter = '/FlateDecode'
+    else:
+        raise ValueError(f"Unsupported image format: {image_format}")
+
+    dictionary = (f"<< /Type /XObject /Subtype /Image /Width {img.width} /Height {img.height} "
+                  f"/ColorSpace {color_space} /BitsPerComponent 8 /Filter {pdf_filter} >>")
+    return dictionary, data
+
+def label_layout(font, filename, position):
+    """计算文件名标签的文字和基线位置（像素坐标），与 add_filename_to_image 的位置一致"""
+    text = filename.rsplit('.', 1)[0]
+    left, top, right, bottom = font.getbbox(text)
+    text_height = bottom - top
+    x, y = position
+    ascent, _ = font.getmetrics()
+    return text, (x + 20, y - text_height + 50 + ascent)
+
+def render_label_image(font, text):
+    """非 Latin-1 的文件名无法用内置字体输出，渲染成小的灰度图片"""
+    left, top, right, bottom = font.getbbox(text)
+    ascent, descent = font.getmetrics()
+    label = Image.new('L', (max(1, right), ascent + descent), 255)
+    ImageDraw.Draw(label).text((0, 0), text, font=font, fill=0)
+    return label
+
+def export_pdf(pages, resized_images, output, image_format=DEFAULT_IMAGE_FORMAT, jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """把排版结果直接写成多页 PDF
+
+    每张发票作为单独压缩的图片放在排版位置上，文件名用 PDF 文字绘制，不生成整页位图，
+    导出时间只与发票像素量有关。output 为文件路径或可写的文件对象；返回页数。
+    """
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'wb') as fp:
+            return export_pdf(pages, resized_images, fp, image_format, jpeg_quality)
+
+    font = get_font()
+    font_size_pt = FONT_SIZE * PIXEL_TO_POINT
+
+    writer = PdfWriter(output)
+    catalog = writer.reserve()
+    pages_root = writer.reserve()
+    font_object = writer.reserve()
+    writer.write_object(font_object, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    page_objects = []
+    for page in pages:
+        xobjects = []
+        content = []
+        for filename, size, position in page:
+            img = load_resized_image(resized_images, filename)
+            if img.size != tuple(size):
+                # 排版时旋转了 90° 的图片
+                img = img.transpose(Image.Transpose.ROTATE_90)
+
+            image_object = writer.reserve()
+            writer.write_object(image_object, *encode_image(img, image_format, jpeg_quality))
+            name = f"Im{len(xobjects) + 1}"
+            xobjects.append((name, image_object))
+
+            x, y = position
+            width_pt = img.width * PIXEL_TO_POINT
+            height_pt = img.height * PIXEL_TO_POINT
+            x_pt = x * PIXEL_TO_POINT
+            y_pt = PAGE_HEIGHT_PT - (y + img.height) * PIXEL_TO_POINT
+            content.append(f"q {width_pt:.3f} 0 0 {height_pt:.3f} {x_pt:.3f} {y_pt:.3f} cm /{name} Do Q")
+
+            text, (text_x, baseline_y) = label_layout(font, filename, position)
+            try:
+                encoded = text.encode('cp1252').decode('latin-1')
+            except UnicodeEncodeError:
+                # 内置字体无法显示的字符，退回到渲染好的标签图片
+                label = render_label_image(font, text)
+                label_object = writer.reserve()
+                writer.write_object(label_object, *encode_image(label, 'FLATE'))
+                label_name = f"Im{len(xobjects) + 1}"
+                xobjects.append((label_name, label_object))
+                ascent, _ = font.getmetrics()
+                label_y = PAGE_HEIGHT_PT - (baseline_y - ascent + label.height) * PIXEL_TO_POINT
+                content.append(f"q {label.width * PIXEL_TO_POINT:.3f} 0 0 {label.height * PIXEL_TO_POINT:.3f} "
+                               f"{text_x * PIXEL_TO_POINT:.3f} {label_y:.3f} cm /{label_name} Do Q")
+            else:
+                content.append(f"BT /F1 {font_size_pt:.3f} Tf {text_x * PIXEL_TO_POINT:.3f} "
+                               f"{PAGE_HEIGHT_PT - baseline_y * PIXEL_TO_POINT:.3f} Td "
+                               f"({escape_pdf_text(encoded)}) Tj ET")
+
+        content_object = writer.reserve()
+        writer.write_object(content_object, "<< /Filter /FlateDecode >>", zlib.compress('\n'.join(content).encode('latin-1')))
+
+        xobject_entries = ' '.join(f"/{name} {number} 0 R" for name, number in xobjects)
+        page_object = writer.reserve()
+        writer.write_object(page_object,
+                            f"<< /Type /Page /Parent {pages_root} 0 R "
+                            f"/MediaBox [0 0 {PAGE_WIDTH_PT} {PAGE_HEIGHT_PT}] "
+                            f"/Resources << /Font << /F1 {font_object} 0 R >> /XObject << {xobject_entries} >> >> "
+                            f"/Contents {content_object} 0 R >>")
+        page_objects.append(page_object)
+
+    kids = ' '.join(f"{number} 0 R" for number in page_objects)
+    writer.write_object(pages_root, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_objects)} >>")
+    writer.write_object(catalog, f"<< /Type /Catalog /Pages {pages_root} 0 R >>")
+    writer.close(catalog)
+    return len(page_objects)
@@ -0,0 +1,112 @@
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+from image_store import EncodedImage
+
+logger = logging.getLogger(__name__)
+
+# 预览缩略图的最长边（像素）和 JPEG 质量
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_QUALITY = 80
+
+# 旋转预览使用的小代理图最长边
+ROTATION_PREVIEW_MAX_SIDE = 480
+
+# 内存中最多保留的缩略图数量（每张约 10-30KB）
+PREVIEW_CACHE_SIZE = 2048
+
+def content_hash(data):
+    """图片字节（或会话中保存的 EncodedImage）的 SHA-256，作为缩略图的缓存键"""
+    if isinstance(data, EncodedImage):
+        return data.digest
+    return hashlib.sha256(data).hexdigest()
+
+# 90° 倍数的旋转用无损的 transpose 完成（PIL 的角度为逆时针）
+TRANSPOSE_FOR_ANGLE = {
+    90: Image.Transpose.ROTATE_90,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_270,
+}
+
+def rotate_image(image, angle, resample=Image.Resampling.BICUBIC):
+    """逆时针旋转图像并扩展画布；90° 的倍数直接转置像素，不插值，其他角度的空白处填充白色"""
+    angle = angle % 360
+    if angle == 0:
+        return image
+    if angle in TRANSPOSE_FOR_ANGLE:
+        return image.transpose(TRANSPOSE_FOR_ANGLE[angle])
+    fillcolor = 255 if image.mode in ('L', '1') else (255,) * len(image.getbands())
+    return image.rotate(angle, resample=resample, expand=True, fillcolor=fillcolor)
+
+def make_thumbnail(data, max_side=THUMBNAIL_MAX_SIDE, quality=THUMBNAIL_QUALITY, angle=0):
+    """把编码后的图片（bytes 或 EncodedImage）缩小为 JPEG 缩略图字节，angle 不为 0 时在缩小后的图上旋转
+
+    JPEG 使用 draft 在解码阶段按 1/2、1/4、1/8 缩小，只解码需要的分辨率。
+    """
+    if isinstance(data, EncodedImage):
+        img = data.open()
+    else:
+        img = Image.open(io.BytesIO(data))
+        img.draft('RGB', (max_side, max_side))
+    with img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.Resampling.BILINEAR, reducing_gap=2.0)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img = rotate_image(img, angle, Image.Resampling.BILINEAR)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+class ThumbnailCache:
+    """以内容哈希为键的缩略图 LRU 缓存，同一版本的图片只生成一次缩略图"""
+
+    def __init__(self, maxsize=PREVIEW_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data, max_side=THUMBNAIL_MAX_SIDE, digest=None, angle=0):
+        """返回图片的缩略图字节；digest 为调用方已经算好的内容哈希，angle 为预览的旋转角度"""
+        key = (digest or content_hash(data), max_side, angle % 360)
+        with self.lock:
+            thumbnail = self.entries.get(key)
+            if thumbnail is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return thumbnail
+            self.misses += 1
+
+        if angle % 360 == 0:
+            thumbnail = make_thumbnail(data, max_side)
+        else:
+            # 旋转预览从缓存的未旋转代理图生成，滑块每次变化都不需要重新解码原图
+            thumbnail = make_thumbnail(self.get(data, max_side, key[0]), max_side, angle=angle)
+        with self.lock:
+            self.entries[key] = thumbnail
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return thumbnail
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries),
+                    'bytes': sum(len(thumbnail) for thumbnail in self.entries.values())}
+
+# 模块级缓存：Streamlit 重新运行脚本时模块不会重新导入，所有会话共享同一份缩略图
+thumbnail_cache = ThumbnailCache()
+
+def get_thumbnail(data, max_side=THUMBNAIL_MAX_SIDE, digest=None, angle=0):
+    """返回图片字节对应的缩略图（JPEG 字节），只用于页面显示"""
+    return thumbnail_cache.get(data, max_side, digest, angle)
@@ -1,19 +1,60 @@
 import cv2
 import numpy as np
-from PIL import Image
-from utils import detectTextOrientation, rotateImage
+from PIL import Image, ImageOps
+from utils import detectTextOrientation, downscaleToMaxSide, getRotationMatrix
+from extract_cache import get_extraction_cache
+import metrics
 import io
+import os
 import re
-import easyocr
 import logging
-import streamlit as st
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 
-# 初始化 EasyOCR reader（只需要执行一次）
-reader = easyocr.Reader(['en'])  # 使用英语模型，可以根据需要添加其他语言
+# 支持的图片扩展名
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# cv2.imdecode 的解码标志，JPEG 可以在解码阶段直接缩小到 1/2、1/4、1/8
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# 发票轮廓检测的二值化阈值
+RECEIPT_THRESHOLD = 180
+
+# 文字方向偏差在该角度（度）以内时不旋转
+ORIENTATION_TOLERANCE = 5
+
+# 轮廓检测在缩小后的代理图上进行，代理图最长边不超过该像素数；None 表示直接在原图上检测
+DETECT_PROXY_MAX_SIDE = 1024
+
+# EasyOCR 使用的语言，可以根据需要添加其他语言
+OCR_LANGUAGES = ['en']
+
+# EasyOCR reader 在第一次真正需要时才加载（会拉起 torch 和模型权重），
+# 模块级缓存保证每个进程只初始化一次；Streamlit 服务器的所有会话共享同一个进程，因此也只加载一次
+_reader = None
+_reader_lock = threading.Lock()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def get_reader():
+    """返回进程内共享的 EasyOCR reader，首次调用时才导入 easyocr 并加载模型"""
+    global _reader
+    if _reader is None:
+        with _reader_lock:
+            if _reader is None:
+                import easyocr
+                logger.info(f"Loading EasyOCR reader for languages {OCR_LANGUAGES}")
+                _reader = easyocr.Reader(OCR_LANGUAGES)
+    return _reader
+
 def slugify(value):
     """将字符串转换为适合文件名的格式"""
     value = str(value)
@@ -22,79 +63,251 @@ def slugify(value):
     value = re.sub(r'[^\w\-]', '', value)  # 移除非字母数字字符
     return value
 
-def process_single_image(uploaded_file, new_image_name):
+def read_image_buffer(uploaded_file):
+    """取出上传文件的字节缓冲区；BytesIO（包括 Streamlit 的 UploadedFile）直接共享内存，不复制"""
+    if hasattr(uploaded_file, 'getbuffer'):
+        return uploaded_file.getbuffer()
+    uploaded_file.seek(0)
+    return uploaded_file.read()
+
+def decode_image(buffer, reduce=1):
+    """将图片字节一次解码为 OpenCV 使用的 BGR 数组，并按 EXIF 方向旋转
+
+    reduce 为 2、4、8 时，JPEG 在解码阶段直接按该比例缩小（见 decode_reduction）。
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    image_cv = cv2.imdecode(data, REDUCED_DECODE_FLAGS[reduce])
+    if image_cv is not None:
+        return image_cv
+
+    # OpenCV 无法解码的格式回退到 PIL
+    pil_image = ImageOps.exif_transpose(Image.open(io.BytesIO(buffer))).convert('RGB')
+    if reduce > 1:
+        pil_image = pil_image.reduce(reduce)
+    return cv2.cvtColor(np.asarray(pil_image), cv2.COLOR_RGB2BGR)
+
+def decode_reduction(scale_factor):
+    """输出缩放比例对应的解码缩小倍数（1、2、4、8），缩小后的分辨率不低于输出分辨率"""
+    reduce = 1
+    while reduce * 2 in REDUCED_DECODE_FLAGS and scale_factor * reduce * 2 <= 1:
+        reduce *= 2
+    return reduce
+
+def bgr_to_pil(image_cv):
+    """将 BGR 数组转换为 RGB 的 PIL 图像，由 PIL 解码器在拷贝时交换通道，不再额外生成 RGB 数组"""
+    height, width = image_cv.shape[:2]
+    return Image.frombuffer('RGB', (width, height), np.ascontiguousarray(image_cv), 'raw', 'BGR', 0, 1)
+
+def make_detection_proxy(image_cv, proxy_max_side=DETECT_PROXY_MAX_SIDE):
+    """生成用于轮廓检测的缩小图，返回 (代理图, 缩放比例)
+
+    只需要发票的大致轮廓（角点随后在原图上精修），因此用 INTER_LINEAR 而不是逐像素平均。
+    """
+    return downscaleToMaxSide(image_cv, proxy_max_side, cv2.INTER_LINEAR)
+
+def refine_corners(image_cv, corners, radius):
+    """在原图角点附近的小窗口内做亚像素角点精修，偏移超过 radius 的结果丢弃"""
+    height, width = image_cv.shape[:2]
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.1)
+    refined = corners.copy()
+    for i, (x, y) in enumerate(corners):
+        # 角点落在图像外（发票被裁切）时无法精修
+        if not (0 <= x < width and 0 <= y < height):
+            continue
+        cx, cy = int(round(x)), int(round(y))
+        x0, x1 = max(0, cx - 2 * radius), min(width, cx + 2 * radius + 1)
+        y0, y1 = max(0, cy - 2 * radius), min(height, cy + 2 * radius + 1)
+        # 只对角点附近的小块做灰度转换，而不是整张原图
+        patch = cv2.cvtColor(image_cv[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        point = np.array([[[x - x0, y - y0]]], dtype=np.float32)
+        cv2.cornerSubPix(patch, point, (radius, radius), (-1, -1), criteria)
+        new_x, new_y = point[0, 0, 0] + x0, point[0, 0, 1] + y0
+        if np.hypot(new_x - x, new_y - y) <= radius:
+            refined[i] = (new_x, new_y)
+    return refined
+
+def detect_receipt_corners(image_cv, proxy_max_side=DETECT_PROXY_MAX_SIDE, proxy=None):
+    """在缩小的代理图上检测发票轮廓，返回原图坐标下的四个角点和裁剪尺寸 (width, height)；未找到时返回 None
+
+    proxy 为 make_detection_proxy 已经生成的 (代理图, 缩放比例)，传入时不再重新缩小。
+    """
+    proxy, scale = proxy or make_detection_proxy(image_cv, proxy_max_side)
+
+    gray = cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY)
+    _, thresh = cv2.threshold(gray, RECEIPT_THRESHOLD, 255, cv2.THRESH_BINARY)
+
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+
+    max_contour = max(contours, key=cv2.contourArea)
+    # 将轮廓点（代理图像素中心）映射回原图坐标，再在原图坐标下求最小外接矩形
+    contour = (max_contour.astype(np.float32) + 0.5) / scale - 0.5
+    rect = cv2.minAreaRect(contour)
+    box = cv2.boxPoints(rect).astype("float32")
+
+    if scale < 1.0:
+        box = refine_corners(image_cv, box, max(2, int(np.ceil(1 / scale))))
+
+    width = int(rect[1][0])
+    height = int(rect[1][1])
+    return box, (width, height)
+
+def scale_matrix(scale, offset=(0, 0)):
+    """像素中心对齐的 3x3 缩放矩阵，可附加平移"""
+    shift = (scale - 1) / 2
+    return np.array([[scale, 0, shift + offset[0]],
+                     [0, scale, shift + offset[1]],
+                     [0, 0, 1]], dtype=np.float64)
+
+def prefilter_source(image_cv, src_pts, scale_factor):
+    """大比例缩小时先对发票所在区域做整数倍区域平均，避免单次插值产生混叠
+
+    返回 (预滤波后的源图, 从预滤波图坐标到原图坐标的 3x3 矩阵)。
+    """
+    factor = int(1 / scale_factor) if scale_factor < 0.5 else 1
+    if factor < 2:
+        return image_cv, np.eye(3)
+
+    height, width = image_cv.shape[:2]
+    x0 = max(0, int(np.floor(src_pts[:, 0].min())))
+    y0 = max(0, int(np.floor(src_pts[:, 1].min())))
+    x1 = min(width, int(np.ceil(src_pts[:, 0].max())) + 1)
+    y1 = min(height, int(np.ceil(src_pts[:, 1].max())) + 1)
+    reduced_width, reduced_height = (x1 - x0) // factor, (y1 - y0) // factor
+    if reduced_width < 1 or reduced_height < 1:
+        return image_cv, np.eye(3)
+
+    roi = image_cv[y0:y0 + reduced_height * factor, x0:x0 + reduced_width * factor]
+    reduced = cv2.resize(roi, (reduced_width, reduced_height), interpolation=cv2.INTER_AREA)
+    return reduced, scale_matrix(factor, (x0, y0))
+
+def extract_receipt(image_cv, new_image_name, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0):
+    """从 BGR 照片中提取发票，透视矫正、方向矫正和缩放合成一个矩阵，只重采样一次
+
+    返回 (发票 BGR 数组, 原图中的四个角点, 旋转角度)；未找到发票轮廓时返回 None。
+    """
+    # 在代理图上检测发票的四个角点，角点已映射回原图坐标
+    start = time.perf_counter()
+    with metrics.span('detect'):
+        proxy = make_detection_proxy(image_cv, proxy_max_side)
+        detection = detect_receipt_corners(image_cv, proxy_max_side, proxy)
+    detect_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"Detection stage for {new_image_name}: {detect_ms:.1f} ms")
+
+    if detection is None:
+        print(f"No contours found in the image.")
+        return None
+
+    src_pts, (width, height) = detection
+    dst_pts = np.array([[0, height-1], [0, 0], [width-1, 0], [width-1, height-1]], dtype="float32")
+    M = cv2.getPerspectiveTransform(src_pts, dst_pts)
+
+    # 检测文字方向：只在代理图上做一次低分辨率的透视矫正
+    proxy_image, proxy_scale = proxy
+    proxy_size = (max(1, round(width * proxy_scale)), max(1, round(height * proxy_scale)))
+    proxy_M = scale_matrix(proxy_scale) @ M @ scale_matrix(1 / proxy_scale)
+    warped_proxy = cv2.warpPerspective(proxy_image, proxy_M, proxy_size)
+    text_angle = detectTextOrientation(warped_proxy, proxy_scale)
+
+    # 调整旋转角度
+    if text_angle > 0:
+        rotation_angle = 360 - text_angle
+    else:
+        rotation_angle = -text_angle
+
+    # 只有当文字方向不正确时才旋转
+    if abs(rotation_angle) > ORIENTATION_TOLERANCE and abs(rotation_angle - 360) > ORIENTATION_TOLERANCE:
+        rotation, (rotated_width, rotated_height) = getRotationMatrix(width, height, rotation_angle)
+        R = np.vstack([rotation, [0, 0, 1]])
+    else:
+        rotation_angle = 0
+        R = np.eye(3)
+        rotated_width, rotated_height = width, height
+
+    # 透视、旋转和缩放合成一个矩阵，从原图直接重采样到最终尺寸
+    with metrics.span('warp'):
+        output_size = (max(1, int(rotated_width * scale_factor)), max(1, int(rotated_height * scale_factor)))
+        S = scale_matrix(scale_factor) if scale_factor != 1.0 else np.eye(3)
+        source, A = prefilter_source(image_cv, src_pts, scale_factor)
+        total = S @ R @ M @ A
+        receipt = cv2.warpPerspective(source, total, output_size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+        # 非 90 度倍数旋转时，画布四角对应的是发票以外的背景，填充为白色
+        if rotation_angle % 90 != 0:
+            corners = np.array([[[0, 0], [width, 0], [width, height], [0, height]]], dtype=np.float64)
+            quad = cv2.transform(corners, (S @ R)[:2])
+            mask = np.zeros(receipt.shape[:2], dtype=np.uint8)
+            cv2.fillConvexPoly(mask, np.round(quad[0]).astype(np.int32), 255)
+            receipt[mask == 0] = 255
+
+    return receipt, src_pts, rotation_angle
+
+def extraction_params(proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0):
+    """影响提取结果的流程参数，作为缓存键的一部分"""
+    return {
+        'threshold': RECEIPT_THRESHOLD,
+        'orientation_tolerance': ORIENTATION_TOLERANCE,
+        'proxy_max_side': proxy_max_side,
+        'scale_factor': scale_factor,
+    }
+
+def resolve_cache(cache):
+    """cache 为 None 时使用默认的磁盘缓存，为 False 时不使用缓存"""
+    if cache is None:
+        return get_extraction_cache()
+    return cache or None
+
+def extract_from_buffer(buffer, new_image_name, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0):
+    """从编码后的图片字节中提取发票，返回 (PIL 图像, 元数据) 或 None"""
+    with metrics.span('extract'):
+        # 直接从缓冲区一次解码为 BGR（含 EXIF 方向），不经过 PIL 和多次颜色转换；
+        # 输出不超过原图一半大小时，JPEG 在解码阶段直接缩小，省去全尺寸解码
+        reduce = decode_reduction(scale_factor)
+        with metrics.span('decode'):
+            image_cv = decode_image(buffer, reduce)
+
+        result = extract_receipt(image_cv, new_image_name, proxy_max_side, scale_factor * reduce)
+        if result is None:
+            return None
+
+        receipt, src_pts, rotation_angle = result
+        # 角点换算回原图坐标（像素中心对齐）
+        src_pts = (src_pts + 0.5) * reduce - 0.5
+        meta = {'corners': src_pts.tolist(), 'angle': float(rotation_angle)}
+        # 将BGR数组转换为PIL图像（转换通道顺序的同时完成唯一一次拷贝）
+        return bgr_to_pil(receipt), meta
+
+def process_single_image(uploaded_file, new_image_name, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0, cache=None):
     try:
-        # 重置文件指针到开始位置
-        uploaded_file.seek(0)
-        
-        # 从上传的文件中读取图像数据
-        image_bytes = uploaded_file.read()
-        
-        # 使用PIL打开图像
-        pil_image = Image.open(io.BytesIO(image_bytes))
-        
-        # 将PIL图像转换为NumPy数组
-        image_np = np.array(pil_image)
-        
-        # 如果图像是RGBA格式，转换为RGB
-        if len(image_np.shape) == 3 and image_np.shape[2] == 4:
-            image_np = cv2.cvtColor(image_np, cv2.COLOR_RGBA2RGB)
-        
-        # 将RGB转换为BGR（OpenCV使用BGR格式）
-        image_cv = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-        
-        gray = cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)
-
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if contours:
-            max_contour = max(contours, key=cv2.contourArea)
-            rect = cv2.minAreaRect(max_contour)
-            box = cv2.boxPoints(rect)
-            box = np.int32(box)
-
-            width = int(rect[1][0])
-            height = int(rect[1][1])
-
-            src_pts = box.astype("float32")
-            dst_pts = np.array([[0, height-1], [0, 0], [width-1, 0], [width-1, height-1]], dtype="float32")
-
-            M = cv2.getPerspectiveTransform(src_pts, dst_pts)
-            warped = cv2.warpPerspective(image_cv, M, (width, height))
-
-            # 检测文字方向
-            text_angle = detectTextOrientation(warped)
-            
-            # 调整旋转角度
-            if text_angle > 0:
-                rotation_angle = 360 - text_angle
-            else:
-                rotation_angle = -text_angle
-
-            # 只有当文字方向不正确时才旋转
-            if abs(rotation_angle) > 5 and abs(rotation_angle - 360) > 5:  # 允许5度的误差
-                rotated = rotateImage(warped, rotation_angle)
-            else:
-                rotated = warped
-
-            # 将BGR转换回RGB
-            rotated_rgb = cv2.cvtColor(rotated, cv2.COLOR_BGR2RGB)
-            
-            # 将NumPy数组转换回PIL图像
-            return Image.fromarray(rotated_rgb)
-        else:
-            print(f"No contours found in the image.")
+        buffer = read_image_buffer(uploaded_file)
+
+        # 相同的输入字节和参数直接从磁盘缓存读取结果
+        cache = resolve_cache(cache)
+        if cache is not None:
+            with metrics.span('cache_lookup'):
+                key = cache.make_key(buffer, extraction_params(proxy_max_side, scale_factor))
+                cached = cache.get(key)
+            if cached is not None:
+                return cached[0]
+
+        result = extract_from_buffer(buffer, new_image_name, proxy_max_side, scale_factor)
+        if result is None:
             return None
 
+        if cache is not None:
+            with metrics.span('cache_store'):
+                cache.put(key, *result)
+        return result[0]
+
     except Exception as e:
         logger.exception(f"Error processing image {new_image_name}: {str(e)}")
         return None
 
-def detectAndCorrectReceipt(uploaded_file, new_image_name):
-    """处理并提取发票部分"""
+def detectAndCorrectReceipt(uploaded_file, new_image_name, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0):
+    """处理并提取发票部分，scale_factor 不为 1 时直接输出缩放后的发票"""
     try:
-        extracted_image = process_single_image(uploaded_file, new_image_name)
+        extracted_image = process_single_image(uploaded_file, new_image_name, proxy_max_side, scale_factor)
         if extracted_image is not None:
             print(f"Successfully processed image: {new_image_name}")
             return extracted_image
@@ -104,3 +317,199 @@ def detectAndCorrectReceipt(uploaded_file, new_image_name):
     except Exception as e:
         print(f"Error in detectAndCorrectReceipt: {str(e)}")
         return None
+
+
+def _read_source(source):
+    """在进程池中读取图片来源：文件路径直接读取，bytes 包装成文件对象"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return io.BytesIO(f.read())
+    return io.BytesIO(source)
+
+def _extract_batch_item(source, new_image_name, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0):
+    """进程池中执行的单张提取任务，返回 (PIL 图像, 元数据)；失败时返回 None，不影响其他图片"""
+    try:
+        return extract_from_buffer(read_image_buffer(_read_source(source)), new_image_name, proxy_max_side, scale_factor)
+    except Exception as e:
+        logger.exception(f"Error processing image {new_image_name}: {str(e)}")
+        return None
+
+def _extract_batch_item_with_metrics(source, new_image_name, proxy_max_side, scale_factor, memory):
+    """在子进程中开启统计执行提取任务，返回 (结果, 本任务的阶段统计)，由主进程合并"""
+    metrics.enable(memory)
+    metrics.use(metrics.recorder)  # fork 出的子进程可能带着某个会话的 Recorder，统一记到全局的 Recorder
+    metrics.recorder.drain()  # fork 出的子进程会带着主进程的统计，先丢弃
+    result = _extract_batch_item(source, new_image_name, proxy_max_side, scale_factor)
+    return result, metrics.recorder.drain()
+
+def _to_picklable_source(source):
+    """上传的文件对象无法跨进程传递，先取出字节；路径和 bytes 原样传递"""
+    if isinstance(source, (str, os.PathLike, bytes)):
+        return source
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    source.seek(0)
+    return source.read()
+
+def _source_bytes(source):
+    """读取图片来源的全部字节，用于计算缓存键"""
+    source = _to_picklable_source(source)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    return source
+
+class _CachedFuture(Future):
+    """命中缓存的图片在产出队列中的占位"""
+
+def detectAndCorrectReceipts(items, max_workers=None, progress_callback=None, stop_check=None, proxy_max_side=DETECT_PROXY_MAX_SIDE, scale_factor=1.0, cache=None, return_meta=False):
+    """使用进程池批量提取发票，按提交顺序逐个产出 (new_image_name, image)
+
+    items 为 (来源, new_image_name) 列表，来源可以是文件路径、bytes 或上传的文件对象。
+    progress_callback(value, current, total) 在每张图片完成后调用，value 为百分比；
+    stop_check() 返回 True 时取消尚未开始的任务并停止产出；proxy_max_side 为轮廓检测代理图的最长边；
+    scale_factor 为输出相对原图的缩放比例，与透视和旋转合并为一次重采样。
+    cache 为 ExtractionCache，None 时使用默认的磁盘缓存，False 时不使用缓存；命中的图片不会提交到进程池。
+    单张图片失败时产出的 image 为 None。return_meta 为 True 时产出 (new_image_name, image, meta)，
+    meta 为检测到的角点和旋转角度（失败时为 None）。
+    """
+    items = list(items)
+    total = len(items)
+    if total == 0:
+        return
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_workers = min(max_workers, total)
+    cache = resolve_cache(cache)
+    params = extraction_params(proxy_max_side, scale_factor)
+    start_stats = cache.stats() if cache is not None else None
+
+    def report(current):
+        if progress_callback is not None:
+            progress_callback(int(current / total * 100), current, total)
+
+    def lookup(source, new_image_name):
+        """在主进程中查询缓存，返回 (缓存键, 命中的结果, 要交给提取任务的来源)
+
+        读取来源失败（文件不存在、无法读取）时记录错误并返回来源为 None，只让这一张图片失败。
+        """
+        try:
+            if cache is None:
+                return None, None, _to_picklable_source(source)
+            with metrics.span('cache_lookup'):
+                source = _source_bytes(source)
+                key = cache.make_key(source, params)
+                return key, cache.get(key), source
+        except Exception as e:
+            logger.exception(f"Error reading image {new_image_name}: {str(e)}")
+            return None, None, None
+
+    def finish(key, result):
+        if result is not None and key is not None:
+            with metrics.span('cache_store'):
+                cache.put(key, *result)
+        return result
+
+    def output(new_image_name, result):
+        image, meta = result if result is not None else (None, None)
+        if return_meta:
+            return new_image_name, image, meta
+        return new_image_name, image
+
+    # 开启统计时，子进程中的阶段统计随结果一起返回
+    session_recorder = metrics.active_recorder()
+    collect_metrics = session_recorder is not None
+
+    def submit(executor, source, new_image_name):
+        if collect_metrics:
+            return executor.submit(_extract_batch_item_with_metrics, source, new_image_name, proxy_max_side, scale_factor, metrics.memory_enabled())
+        return executor.submit(_extract_batch_item, source, new_image_name, proxy_max_side, scale_factor)
+
+    def collect(future):
+        result = future.result()
+        if collect_metrics and not isinstance(future, _CachedFuture):
+            result, stages = result
+            session_recorder.merge(stages)
+        return result
+
+    try:
+        # 单进程时直接在当前进程处理，省去进程启动和数据传递的开销
+        if max_workers == 1:
+            for idx, (source, new_image_name) in enumerate(items):
+                if stop_check is not None and stop_check():
+                    logger.info("Batch extraction cancelled")
+                    return
+                key, cached, source = lookup(source, new_image_name)
+                if cached is None and source is not None:
+                    try:
+                        cached = finish(key, _extract_batch_item(source, new_image_name, proxy_max_side, scale_factor))
+                    except Exception as e:
+                        logger.exception(f"Error processing image {new_image_name}: {str(e)}")
+                yield output(new_image_name, cached)
+                report(idx + 1)
+            return
+
+        # 同时在途的任务数有上限，避免大批量时一次性把所有图片读入内存
+        window = max_workers * 2
+        pending = deque()
+        next_item = 0
+        done = 0
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            while next_item < total or pending:
+                while next_item < total and len(pending) < window:
+                    source, new_image_name = items[next_item]
+                    key, cached, source = lookup(source, new_image_name)
+                    if cached is not None or source is None:
+                        # 命中缓存或读取失败的图片用已完成的 Future 占位，保持产出顺序
+                        future = _CachedFuture()
+                        future.set_result(cached)
+                        key = None
+                    else:
+                        future = submit(executor, source, new_image_name)
+                    pending.append((new_image_name, key, future))
+                    next_item += 1
+
+                new_image_name, key, future = pending.popleft()
+                try:
+                    result = finish(key, collect(future))
+                except Exception as e:
+                    logger.exception(f"Error processing image {new_image_name}: {str(e)}")
+                    result = None
+
+                if stop_check is not None and stop_check():
+                    logger.info("Batch extraction cancelled")
+                    return
+                done += 1
+                yield output(new_image_name, result)
+                report(done)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        if cache is not None:
+            stats = cache.stats()
+            hits = stats['hits'] - start_stats['hits']
+            misses = stats['misses'] - start_stats['misses']
+            logger.info(f"Extraction cache: {hits} hits, {misses} misses")
+
+def extractReceiptsFromFolder(input_folder, output_folder=None, max_workers=None, progress_callback=None, stop_check=None, scale_factor=1.0, cache=None):
+    """并行提取文件夹中的所有发票，保存为 PNG 到 output_folder（默认为 input_folder/receipts）"""
+    if output_folder is None:
+        output_folder = os.path.join(input_folder, 'receipts')
+    os.makedirs(output_folder, exist_ok=True)
+
+    image_files = sorted(f for f in os.listdir(input_folder) if f.lower().endswith(IMAGE_EXTENSIONS))
+    items = [(os.path.join(input_folder, f), f.rsplit('.', 1)[0]) for f in image_files]
+
+    saved = 0
+    for new_image_name, extracted_image in detectAndCorrectReceipts(items, max_workers, progress_callback, stop_check, scale_factor=scale_factor, cache=cache):
+        if extracted_image is not None:
+            extracted_image.save(os.path.join(output_folder, f"{new_image_name}.png"))
+            saved += 1
+        else:
+            print(f"Failed to process image: {new_image_name}")
+
+    print(f"Extracted {saved}/{len(items)} receipts into {output_folder}")
+    return saved
@@ -1,22 +1,125 @@
+import contextvars
+import io
 import os
 import cv2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+import metrics
+
+# 缩放方式：'quality' 为原来的整图 LANCZOS；'fast' 先在解码阶段（JPEG draft）或用整数倍 reduce 缩小，
+# 剩余的部分再用 LANCZOS，缩小比例较大时结果与 'quality' 几乎一致
+RESIZE_MODES = ('quality', 'fast')
+DEFAULT_RESIZE_MODE = 'quality'
+
+# 'fast' 模式下 reduce 之后保留的余量：先整数倍缩小到目标尺寸的 REDUCING_GAP 倍以上，再做 LANCZOS
+REDUCING_GAP = 3.0
 
 def get_image_size(image_path):
     with Image.open(image_path) as img:
         return img.size
 
-def resize_image(image, scale_factor):
+@metrics.timed('resize')
+def resize_image(image, scale_factor, mode=DEFAULT_RESIZE_MODE):
     """调整图像大小并返回调整后的图像对象"""
     new_size = (int(image.width * scale_factor), int(image.height * scale_factor))
+    if mode == 'fast':
+        return image.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    if mode != 'quality':
+        raise ValueError(f"Unknown resize mode: {mode}. Available: {', '.join(RESIZE_MODES)}")
     resized_image = image.resize(new_size, Image.Resampling.LANCZOS)  # 使用 LANCZOS 替代 ANTIALIAS
     return resized_image
 
-def process_images(input_folder, output_folder):
+def open_resized(source, scale_factor, mode=DEFAULT_RESIZE_MODE):
+    """打开图片文件（路径、bytes 或 PIL 图像）并缩放
+
+    'fast' 模式下 JPEG 只解码到不小于目标尺寸的 1/2、1/4、1/8 分辨率，省去大部分解码和重采样工作。
+    """
+    if isinstance(source, Image.Image):
+        return resize_image(source, scale_factor, mode)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+
+    with Image.open(source) as img:
+        new_size = (int(img.width * scale_factor), int(img.height * scale_factor))
+        with metrics.span('resize_decode'):
+            if mode == 'fast':
+                img.draft(img.mode, new_size)
+            img.load()
+        if img.size == new_size:
+            return img.copy()
+        # draft 之后的尺寸可能已经变小，按剩余比例缩放到与原图计算的目标尺寸一致
+        if mode == 'fast':
+            with metrics.span('resize'):
+                return img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        return resize_image(img, scale_factor, mode)
+
+def resize_file(input_path, output_path, scale_factor, mode=DEFAULT_RESIZE_MODE):
+    """缩放一张图片文件并保存，返回 (原始尺寸, 调整后尺寸)"""
+    original_size = get_image_size(input_path)
+    resized_image = open_resized(input_path, scale_factor, mode)
+    resized_image.save(output_path)
+    return original_size, resized_image.size
+
+def resize_batch(items, scale_factor, mode=DEFAULT_RESIZE_MODE, max_workers=None, progress_callback=None, stop_check=None, loader=None):
+    """用线程池批量缩放图片，按提交顺序逐个产出 (key, resized_image)
+
+    items 为 (key, 来源) 列表，来源可以是文件路径、bytes 或 PIL 图像；loader 不为 None 时先在线程中用
+    loader(来源) 把来源转换为上述类型。PIL 的解码和重采样会释放 GIL，线程池即可并行，也不需要在进程间
+    传递图片。progress_callback(value, current, total) 和 stop_check() 与 detectAndCorrectReceipts
+    的约定相同；单张失败时产出的图片为 None。
+    """
+    items = list(items)
+    total = len(items)
+    if total == 0:
+        return
+    max_workers = min(max_workers or os.cpu_count() or 1, total)
+
+    def resize_one(source):
+        try:
+            if loader is not None:
+                source = loader(source)
+            return open_resized(source, scale_factor, mode)
+        except Exception as e:
+            print(f"Error resizing image: {str(e)}")
+            return None
+
+    # 同时在途的任务数有上限，避免一次性把所有缩放结果留在内存中
+    window = max_workers * 2
+    pending = deque()
+    next_item = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while next_item < total or pending:
+                while next_item < total and len(pending) < window:
+                    key, source = items[next_item]
+                    # 在当前上下文中运行，工作线程使用与调用方相同的 Recorder
+                    pending.append((key, executor.submit(contextvars.copy_context().run, resize_one, source)))
+                    next_item += 1
+
+                key, future = pending.popleft()
+                resized_image = future.result()
+                if stop_check is not None and stop_check():
+                    return
+                done += 1
+                yield key, resized_image
+                if progress_callback is not None:
+                    progress_callback(int(done / total * 100), done, total)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def process_images(input_folder, output_folder, scale_factor=0.28, mode='fast', max_workers=None, progress_callback=None,
+                   stop_check=None):
+    """缩放文件夹中的所有图片，每完成一张就保存，返回保存的张数
+
+    progress_callback 和 stop_check 原样传给 resize_batch。
+    """
     # 确保输入文件夹路径存在
     if not os.path.exists(input_folder):
         print(f"输入文件夹 {input_folder} 不存在")
-        return
+        return 0
 
     # 创建输出文件夹（如果不存在）
     if not os.path.exists(output_folder):
@@ -30,24 +133,23 @@ def process_images(input_folder, output_folder):
 
     if not image_files:
         print(f"在 {input_folder} 中没有找到图片文件")
-        return
+        return 0
+
+    # 多线程处理所有图片文件，缩放结果按顺序保存
+    items = [(image_file, os.path.join(input_folder, image_file)) for image_file in image_files]
+    saved = 0
+    for image_file, resized_image in resize_batch(items, scale_factor, mode, max_workers, progress_callback, stop_check):
+        if resized_image is None:
+            continue
+        resized_image.save(os.path.join(output_folder, image_file))
+        saved += 1
 
-    # 处理每个图片文件
-    for image_file in image_files:
-        input_path = os.path.join(input_folder, image_file)
-        output_path = os.path.join(output_folder, image_file)
-        
-        # 获取原始尺寸
-        original_width, original_height = get_image_size(input_path)
-        
-        # 调整图像大小并保存
-        resized_image = resize_image(input_path, 0.28)
-        
-        # 获取调整后的尺寸
+        # 获取原始尺寸和调整后的尺寸
+        original_width, original_height = get_image_size(os.path.join(input_folder, image_file))
         resized_width, resized_height = resized_image.size
-        
+
         print(f"图片: {image_file}")
         print(f"  原始尺寸: {original_width}x{original_height}")
         print(f"  调整后尺寸: {resized_width}x{resized_height}")
         print()
-
+    return saved
@@ -0,0 +1,101 @@
+import json
+import os
+import cv2
+import numpy as np
+
+# 合成照片的常用分辨率（宽, 高）
+RESOLUTIONS = {
+    '2mp': (1600, 1200),
+    '8mp': (3264, 2448),
+    '12mp': (4000, 3000),
+}
+
+# 背景类型，亮度都低于发票检测的二值化阈值
+BACKGROUNDS = ('dark', 'wood', 'gradient')
+
+# 发票上的文字内容
+RECEIPT_WORDS = ['TOTAL', 'TAX', 'CASH', 'CHANGE', 'ITEM', 'QTY', 'PRICE', 'STORE', 'DATE', 'VISA',
+                 'COFFEE', 'BREAD', 'MILK', 'RICE', 'TEA', 'SUBTOTAL', 'RECEIPT', 'THANK', 'YOU']
+
+def make_receipt(rng, width=900, height=1500):
+    """生成一张白底黑字的发票图像（BGR），文字行水平排列"""
+    receipt = np.full((height, width, 3), 250, dtype=np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    scale = width / 700
+    line_height = int(45 * scale)
+    y = int(80 * scale)
+    while y < height - line_height:
+        words = rng.choice(RECEIPT_WORDS, size=rng.integers(2, 5))
+        text = ' '.join(words) + f"  {rng.integers(1, 999)}.{rng.integers(0, 99):02d}"
+        cv2.putText(receipt, text, (int(40 * scale), y), font, scale, (20, 20, 20), max(1, int(2 * scale)), cv2.LINE_AA)
+        y += line_height
+    return receipt
+
+def make_background(rng, size, kind='dark'):
+    """生成照片背景（BGR），size 为 (宽, 高)"""
+    width, height = size
+    if kind == 'dark':
+        background = np.full((height, width, 3), 60, dtype=np.uint8)
+    elif kind == 'wood':
+        stripes = (np.sin(np.linspace(0, 40, height))[:, None] * 20 + 90).astype(np.uint8)
+        background = np.repeat(stripes, width, axis=1)[:, :, None] * np.array([[[0.6, 0.8, 1.0]]])
+        background = background.astype(np.uint8)
+    elif kind == 'gradient':
+        ramp = np.linspace(30, 130, width, dtype=np.float32)[None, :]
+        background = np.repeat(np.repeat(ramp, height, axis=0)[:, :, None], 3, axis=2).astype(np.uint8)
+    else:
+        raise ValueError(f"Unknown background: {kind}. Available: {', '.join(BACKGROUNDS)}")
+    noise = rng.integers(-12, 13, size=background.shape, dtype=np.int16)
+    return np.clip(background.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+def make_receipt_photo(resolution=RESOLUTIONS['12mp'], rotation=0, skew=6.0, background='dark', seed=0):
+    """生成一张拍摄发票的合成照片
+
+    发票先按 rotation（90 的倍数，逆时针）旋转，再以 ±skew 度的随机倾斜和轻微透视放到背景中央。
+    返回 (照片 BGR, 元数据)，元数据包含发票在照片中的四个角点和旋转角度。
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    receipt = make_receipt(rng)
+    receipt = np.ascontiguousarray(np.rot90(receipt, k=(rotation // 90) % 4))
+    receipt_height, receipt_width = receipt.shape[:2]
+
+    # 发票占照片短边的 70% 左右，随机倾斜并加入少量透视
+    fit = 0.7 * min(width / receipt_width, height / receipt_height)
+    half = np.array([[-receipt_width, -receipt_height], [receipt_width, -receipt_height],
+                     [receipt_width, receipt_height], [-receipt_width, receipt_height]], dtype=np.float64) * fit / 2
+    angle = np.deg2rad(rng.uniform(-skew, skew))
+    rotation_matrix = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    jitter = rng.uniform(-0.02, 0.02, size=(4, 2)) * min(width, height)
+    corners = half @ rotation_matrix.T + jitter + np.array([width / 2, height / 2])
+
+    src = np.array([[0, 0], [receipt_width, 0], [receipt_width, receipt_height], [0, receipt_height]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(src, corners.astype(np.float32))
+    photo = make_background(rng, resolution, background)
+    warped = cv2.warpPerspective(receipt, matrix, resolution, flags=cv2.INTER_LINEAR)
+    mask = cv2.warpPerspective(np.full((receipt_height, receipt_width), 255, dtype=np.uint8), matrix, resolution)
+    photo[mask > 127] = warped[mask > 127]
+
+    meta = {'corners': corners.tolist(), 'rotation': rotation % 360, 'skew': float(np.rad2deg(angle)),
+            'background': background, 'resolution': list(resolution), 'seed': seed}
+    return photo, meta
+
+def generate_dataset(folder, count, resolution=RESOLUTIONS['12mp'], seed=0, jpeg_quality=90):
+    """在文件夹中生成 count 张 JPEG 合成照片和 ground_truth.json，返回照片路径列表
+
+    旋转角度和背景依次循环，倾斜和透视由 seed 决定，相同参数生成的数据集完全相同。
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    truth = {}
+    for index in range(count):
+        photo, meta = make_receipt_photo(resolution, rotation=(index % 4) * 90,
+                                         background=BACKGROUNDS[index % len(BACKGROUNDS)], seed=seed + index)
+        filename = f"synthetic_{index:04d}.jpg"
+        path = os.path.join(folder, filename)
+        cv2.imwrite(path, photo, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        paths.append(path)
+        truth[filename] = meta
+    with open(os.path.join(folder, 'ground_truth.json'), 'w', encoding='utf-8') as f:
+        json.dump(truth, f, indent=2)
+    return paths
@@ -1,13 +1,30 @@
 import cv2
 import numpy as np
 import math
+import functools
 import logging
 from PIL import Image
+import metrics
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def downscaleToMaxSide(image, max_side, interpolation=cv2.INTER_AREA):
+    """按整数倍缩小图像，使最长边不超过 max_side，返回 (缩小后的图像, 缩放比例)
+
+    整数倍的 INTER_AREA 走 OpenCV 的快速路径，比任意比例缩小快数倍；只需要粗略轮廓时可以传入
+    INTER_LINEAR，每个输出像素只读取少量源像素，速度更快。
+    右侧和底部不足一个整数块的像素被舍弃，因此缩放比例严格为 1 / factor。
+    """
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image, 1.0
+    factor = -(-max(height, width) // max_side)
+    reduced_width, reduced_height = max(1, width // factor), max(1, height // factor)
+    cropped = image[:reduced_height * factor, :reduced_width * factor]
+    return cv2.resize(cropped, (reduced_width, reduced_height), interpolation=interpolation), 1.0 / factor
+
 def detect_text_lines(image):
     """检测图像中的文本行"""
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -47,16 +64,79 @@ def detect_dominant_orientation(angles):
     dominant_angle = max(angle_counts, key=angle_counts.get)
     return dominant_angle
 
-def detectTextOrientation(image):
-    """检测文本方向并返回需要旋转的角度"""
-    text_lines = detect_text_lines(image)
-    if not text_lines:
-        logger.warning("No text lines detected")
-        return 0
-    
-    angles = compute_line_angles(text_lines)
-    dominant_angle = detect_dominant_orientation(angles)
-    
+# 方向估计在缩小后的副本上进行，副本最长边不超过该像素数
+ORIENTATION_MAX_SIDE = 1000
+
+# 以下参数对应原图分辨率，缩小后按比例换算
+LINE_KERNEL_SIZE = (20, 1)
+MIN_LINE_AREA = 100
+ANGLE_BIN = 5
+
+@functools.lru_cache(maxsize=None)
+def min_area_rect_angles_negative():
+    """不同版本的 OpenCV 中 minAreaRect 的角度范围不同（[-90, 0) 或 (0, 90]），用一个倾斜矩形探测一次"""
+    points = cv2.boxPoints(((50, 50), (60, 20), 10))
+    return cv2.minAreaRect(points)[2] < 0
+
+def estimate_line_angles(image, image_scale=1.0, max_side=ORIENTATION_MAX_SIDE):
+    """在缩小的副本上用连通域统计一次性计算所有文本行的角度
+
+    image_scale 表示传入的图像相对原图已经缩小的比例。每个连通域的方向由二阶中心矩给出，
+    再按当前 OpenCV 版本中 minAreaRect 的角度约定折叠，与 compute_line_angles 的结果一致。
+    """
+    # 先转灰度再缩小，缩小只需处理单通道
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    gray, scale = downscaleToMaxSide(gray, max_side)
+    total_scale = scale * image_scale
+
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    kernel_width = max(1, round(LINE_KERNEL_SIZE[0] * total_scale))
+    kernel_height = max(1, round(LINE_KERNEL_SIZE[1] * total_scale))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_width, kernel_height))
+    connected = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+
+    count, labels = cv2.connectedComponents(connected, connectivity=8)
+    if count <= 1:
+        return np.empty(0)
+
+    # 用 bincount 一次性求出每个连通域的面积、一阶矩和二阶矩
+    ys, xs = np.nonzero(labels)
+    ids = labels[ys, xs]
+    xs = xs.astype(np.float64)
+    ys = ys.astype(np.float64)
+    area = np.bincount(ids, minlength=count)
+    sum_x = np.bincount(ids, xs, minlength=count)
+    sum_y = np.bincount(ids, ys, minlength=count)
+    sum_xx = np.bincount(ids, xs * xs, minlength=count)
+    sum_yy = np.bincount(ids, ys * ys, minlength=count)
+    sum_xy = np.bincount(ids, xs * ys, minlength=count)
+
+    # 过滤小连通域，可能是噪声（面积阈值按缩放比例换算）
+    keep = area > MIN_LINE_AREA * total_scale * total_scale
+    keep[0] = False
+    area = area[keep]
+    mean_x = sum_x[keep] / area
+    mean_y = sum_y[keep] / area
+    mu20 = sum_xx[keep] / area - mean_x * mean_x
+    mu02 = sum_yy[keep] / area - mean_y * mean_y
+    mu11 = sum_xy[keep] / area - mean_x * mean_y
+
+    theta = np.degrees(0.5 * np.arctan2(2 * mu11, mu20 - mu02))
+    folded = np.mod(theta, 90)
+    if min_area_rect_angles_negative():
+        # minAreaRect 返回 [-90, 0)，compute_line_angles 折叠后为 [-45, 45)
+        return np.where(folded < 45, folded, folded - 90)
+    # minAreaRect 返回 (0, 90]，compute_line_angles 折叠后为 [0, 45]
+    return np.minimum(folded, 90 - folded)
+
+def dominant_angle_histogram(angles):
+    """用 NumPy 直方图求主要方向，角度按 ANGLE_BIN 度取整"""
+    bins = np.round(np.asarray(angles) / ANGLE_BIN).astype(np.int64)
+    values, counts = np.unique(bins, return_counts=True)
+    return int(values[np.argmax(counts)]) * ANGLE_BIN
+
+def rotation_from_dominant_angle(dominant_angle):
+    """根据主要方向计算需要旋转的角度"""
     # 只有当倾斜角度超过阈值时才进行旋转
     threshold = 5  # 可以根据需要调整这个阈值
     if abs(dominant_angle) <= threshold:
@@ -76,13 +156,29 @@ def detectTextOrientation(image):
     logger.info(f"Detected dominant angle: {dominant_angle}, Rotation angle: {rotation_angle}")
     return rotation_angle
 
-def rotateImage(image, angle):
-    """旋转图像"""
-    if angle == 0:
-        logger.info("No rotation needed")
-        return image
+@metrics.timed('orientation')
+def detectTextOrientation(image, image_scale=1.0):
+    """检测文本方向并返回需要旋转的角度（在缩小的副本上向量化计算）"""
+    angles = estimate_line_angles(image, image_scale)
+    if angles.size == 0:
+        logger.warning("No text lines detected")
+        return 0
     
-    height, width = image.shape[:2]
+    return rotation_from_dominant_angle(dominant_angle_histogram(angles))
+
+def detectTextOrientationContours(image):
+    """逐个轮廓计算角度的原始实现，保留用于对比和基准测试"""
+    text_lines = detect_text_lines(image)
+    if not text_lines:
+        logger.warning("No text lines detected")
+        return 0
+    
+    angles = compute_line_angles(text_lines)
+    dominant_angle = detect_dominant_orientation(angles)
+    return rotation_from_dominant_angle(dominant_angle)
+
+def getRotationMatrix(width, height, angle):
+    """计算带画布扩展的旋转矩阵，返回 (2x3 矩阵, (new_width, new_height))"""
     center = (width // 2, height // 2)
     
     # 计算新的图像尺寸
@@ -97,8 +193,19 @@ def rotateImage(image, angle):
     rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
     rotation_matrix[0, 2] += (new_width - width) / 2
     rotation_matrix[1, 2] += (new_height - height) / 2
+    return rotation_matrix, (new_width, new_height)
+
+@metrics.timed('rotate')
+def rotateImage(image, angle):
+    """旋转图像"""
+    if angle == 0:
+        logger.info("No rotation needed")
+        return image
+    
+    height, width = image.shape[:2]
+    rotation_matrix, new_size = getRotationMatrix(width, height, angle)
     
-    rotated = cv2.warpAffine(image, rotation_matrix, (new_width, new_height), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    rotated = cv2.warpAffine(image, rotation_matrix, new_size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
     
     logger.info(f"Image rotated by {angle} degrees")
     return rotated
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from process_receipt import IMAGE_EXTENSIONS, detectAndCorrectReceipts
+from layout_images import DEFAULT_LAYOUT_MODE, DEFAULT_PACKING_ENGINE, encode_page, layout_images, render_page
+
+logger = logging.getLogger(__name__)
+
+# 清单文件名，保存在输出文件夹中
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 2
+
+# 修改时间距现在不足该秒数的文件可能还在写入（扫描仪正在保存），留到下一轮再处理
+SETTLE_SECONDS = 2.0
+
+# 监视模式两次扫描之间的间隔（秒）
+DEFAULT_INTERVAL = 10.0
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json_atomic(path, data):
+    """先写临时文件再替换，进程在写入中途退出时旧文件保持完整"""
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+class Manifest:
+    """输出文件夹中所有输入的处理记录
+
+    files 以输入文件名为键，记录 path、mtime、size、hash、dims（缩放后发票的尺寸）、angle、receipt
+    （缩放后发票的文件名，失败时为 None）；pages 为每页的签名和输出文件名，用于判断哪些页面需要重新渲染。
+    每处理完一张图片就写回磁盘，中途崩溃后重新运行只会处理尚未记录的文件。
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.files = {}
+        self.pages = []
+        # 清单版本或参数变化时，旧清单中记录的发票文件不再有效，由 sync_folder 删除
+        self.stale_receipts = []
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable manifest {path}: {str(e)}")
+                data = {}
+            if data.get('version') == MANIFEST_VERSION and data.get('params') == params:
+                self.files = data.get('files', {})
+                self.pages = data.get('pages', [])
+            elif data:
+                logger.info("Manifest parameters changed, reprocessing all files")
+                old_files = data.get('files')
+                if isinstance(old_files, dict):
+                    self.stale_receipts = [entry['receipt'] for entry in old_files.values()
+                                           if isinstance(entry, dict) and entry.get('receipt')]
+
+    def save(self):
+        write_json_atomic(self.path, {'version': MANIFEST_VERSION, 'params': self.params,
+                                      'files': self.files, 'pages': self.pages})
+
+def scan_folder(input_folder, manifest, now=None):
+    """比较输入文件夹和清单，返回 (需要处理的文件名列表, 已删除的文件名列表)
+
+    修改时间和大小都没变的文件直接跳过，不重新计算哈希；内容哈希没变的文件只更新修改时间。
+    """
+    now = time.time() if now is None else now
+    current = {}
+    for filename in sorted(os.listdir(input_folder)):
+        path = os.path.join(input_folder, filename)
+        if filename.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+            try:
+                current[filename] = os.stat(path)
+            except OSError as e:
+                logger.warning(f"Skipping {filename} this round: {str(e)}")
+
+    changed = []
+    for filename, stat in current.items():
+        if now - stat.st_mtime < SETTLE_SECONDS:
+            continue
+        entry = manifest.files.get(filename)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            continue
+        try:
+            digest = file_hash(os.path.join(input_folder, filename))
+        except OSError as e:
+            # 文件在列出之后被删除或改名，留到下一轮再处理
+            logger.warning(f"Skipping {filename} this round: {str(e)}")
+            continue
+        if entry is not None and entry['hash'] == digest:
+            entry['mtime'] = stat.st_mtime
+            entry['size'] = stat.st_size
+            continue
+        changed.append((filename, digest, stat))
+
+    removed = [filename for filename in manifest.files if filename not in current]
+    return changed, removed
+
+def receipt_name(filename):
+    """发票文件名保留完整的输入文件名（r0.jpg -> r0.jpg.png），r0.jpg 和 r0.png 不会互相覆盖"""
+    return f"{filename}.png"
+
+def receipt_label(filename):
+    """页面上显示的标签与其他入口一致，为去掉扩展名的输入文件名"""
+    return filename.rsplit('.', 1)[0]
+
+def remove_receipt(receipts_folder, receipt):
+    try:
+        os.remove(os.path.join(receipts_folder, receipt))
+    except OSError:
+        pass
+
+def page_signature(page, files_by_receipt):
+    """页面内容的签名：每张发票的位置、尺寸和内容哈希"""
+    digest = hashlib.sha256()
+    for filename, size, position in page:
+        digest.update(json.dumps([filename, list(size), list(position), files_by_receipt[filename]['hash']]).encode('utf-8'))
+    return digest.hexdigest()
+
+def sync_folder(input_folder, output_folder=None, max_workers=None, scale_factor=0.3, engine=DEFAULT_PACKING_ENGINE,
+                mode=DEFAULT_LAYOUT_MODE, stop_check=None):
+    """处理输入文件夹中新增或改变的图片，并只重新渲染内容变化的页面，返回本轮的统计信息"""
+    if output_folder is None:
+        output_folder = os.path.join(input_folder, 'output')
+    receipts_folder = os.path.join(output_folder, 'receipts')
+    os.makedirs(receipts_folder, exist_ok=True)
+
+    manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME), {'scale_factor': scale_factor})
+    changed, removed = scan_folder(input_folder, manifest)
+
+    for receipt in manifest.stale_receipts:
+        remove_receipt(receipts_folder, receipt)
+    for filename in removed:
+        entry = manifest.files.pop(filename)
+        if entry.get('receipt'):
+            remove_receipt(receipts_folder, entry['receipt'])
+
+    # 提取新增或改变的图片，每完成一张就保存发票并写回清单
+    start = time.perf_counter()
+    info = {filename: (digest, stat) for filename, digest, stat in changed}
+    items = [(os.path.join(input_folder, filename), filename) for filename, _, _ in changed]
+    processed = 0
+    for filename, image, meta in detectAndCorrectReceipts(items, max_workers, stop_check=stop_check,
+                                                          scale_factor=scale_factor, return_meta=True):
+        digest, stat = info[filename]
+        # 重新处理的文件先删除上一次的发票，提取失败时不会留下旧内容
+        previous_entry = manifest.files.get(filename)
+        if previous_entry is not None and previous_entry.get('receipt'):
+            remove_receipt(receipts_folder, previous_entry['receipt'])
+        entry = {'path': os.path.join(input_folder, filename), 'mtime': stat.st_mtime, 'size': stat.st_size,
+                 'hash': digest, 'dims': None, 'angle': None, 'receipt': None}
+        if image is not None:
+            receipt = receipt_name(filename)
+            image.save(os.path.join(receipts_folder, receipt))
+            entry.update(dims=list(image.size), angle=meta['angle'], receipt=receipt)
+        else:
+            print(f"Failed to process image: {filename}")
+        manifest.files[filename] = entry
+        manifest.save()
+        processed += 1
+    extract_seconds = time.perf_counter() - start
+
+    # 排版只需要清单中记录的尺寸，不重新打开发票文件
+    files_by_receipt = {entry['receipt']: entry for entry in manifest.files.values() if entry['receipt']}
+    labels = {entry['receipt']: receipt_label(filename) for filename, entry in manifest.files.items() if entry['receipt']}
+    pages = layout_images([(receipt, tuple(entry['dims'])) for receipt, entry in sorted(files_by_receipt.items())], engine, mode=mode)
+
+    previous = manifest.pages
+    new_pages = []
+    rendered = 0
+    for index, page in enumerate(pages):
+        signature = page_signature(page, files_by_receipt)
+        output = f"page_{index + 1}.png"
+        output_path = os.path.join(output_folder, output)
+        if not (index < len(previous) and previous[index]['signature'] == signature and os.path.exists(output_path)):
+            canvas = render_page(page, receipts_folder, labels)
+            data = encode_page(canvas)
+            canvas.close()
+            with open(f"{output_path}.tmp", 'wb') as f:
+                f.write(data)
+            os.replace(f"{output_path}.tmp", output_path)
+            rendered += 1
+        new_pages.append({'signature': signature, 'output': output, 'receipts': [receipt for receipt, _, _ in page]})
+
+    # 页数变少时删除多出来的旧页面
+    for old_page in previous[len(pages):]:
+        try:
+            os.remove(os.path.join(output_folder, old_page['output']))
+        except OSError:
+            pass
+    manifest.pages = new_pages
+    manifest.save()
+
+    return {'processed': processed, 'removed': len(removed), 'pages': len(pages), 'rendered': rendered,
+            'extract_seconds': extract_seconds}
+
+def watch_folder(input_folder, output_folder=None, interval=DEFAULT_INTERVAL, max_workers=None, scale_factor=0.3,
+                 engine=DEFAULT_PACKING_ENGINE, mode=DEFAULT_LAYOUT_MODE):
+    """持续监视输入文件夹，每隔 interval 秒同步一次，Ctrl+C 退出"""
+    print(f"Watching {input_folder} every {interval:.0f}s (Ctrl+C to stop)")
+    try:
+        while True:
+            try:
+                result = sync_folder(input_folder, output_folder, max_workers, scale_factor, engine, mode)
+            except Exception as e:
+                # 清单在每张图片处理完后都会保存，下一轮从中断处继续
+                logger.exception(f"Sync failed, retrying in {interval:.0f}s: {str(e)}")
+                time.sleep(interval)
+                continue
+            if result['processed'] or result['removed'] or result['rendered']:
+                rate = result['processed'] / result['extract_seconds'] if result['extract_seconds'] > 0 else 0.0
+                print(f"{time.strftime('%H:%M:%S')} processed {result['processed']} new/changed images ({rate:.2f} images/s), "
+                      f"removed {result['removed']}, re-rendered {result['rendered']}/{result['pages']} pages")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")